@@ -25,8 +25,9 @@ if __name__ == '__main__':
     pos_frames = []
     neg_frames = []
     for idx in dataset.train_start_indices:
-        features = dataset.train_features[0, idx]
-        label = dataset.train_event_matrix[idx, 0]
+        features, event_matrix = dataset.get_train_crop(idx, crop_size=1)
+        features = features[0, 0]
+        label = event_matrix[0, 0]
         if label:
             pos_frames.append(features)
         else:
@@ -8,6 +8,8 @@ import random
 
 from dataset.dataset_utils import get_film_clap_paths_and_labels, read_multichannel_audio
 from dataset.spectogram.preprocess import multichannel_complex_to_log_mel
+from dataset.spectogram.fft_backends import get_fft_backend
+from dataset.spectogram.spectogram_configs import NFFT
 from dataset.waveform.waveform_dataset import split_to_frames_with_hop_size
 from utils.metric_utils import calculate_metrics, f_score
 from utils.plot_utils import plot_sample_features
@@ -49,14 +51,14 @@ class SVM_detector:
                 self.svm = pickle.load(file)
 
 def get_raw_data():
-    NFFT = 2**int(np.ceil(np.log2(cfg.frame_size)))
+    fft_backend = get_fft_backend()
 
     audio_paths_labels_and_names = get_film_clap_paths_and_labels("../../data/FilmClap", time_margin=cfg.time_margin)
 
     features = []
     label_sets = []
     file_names = []
-    for i, (audio_path, start_times, end_times, audio_name) in enumerate(audio_paths_labels_and_names):
+    for i, (audio_path, start_times, end_times, audio_name, _) in enumerate(audio_paths_labels_and_names):
         assert "_".join(audio_name.split("_")[1:]) in audio_path
         waveform = read_multichannel_audio(audio_path, target_fs=cfg.working_sample_rate)
         waveform = waveform.T  # -> (channels, samples)
@@ -64,7 +66,7 @@ def get_raw_data():
         frames, labels = split_to_frames_with_hop_size(waveform, start_times, end_times)
         frames = np.concatenate(frames, axis=0)
         frames *= np.hanning(frames.shape[1])
-        complex_spectogram = np.fft.rfft(frames, NFFT)
+        complex_spectogram = fft_backend.rfft(frames, NFFT)
         mel_features = multichannel_complex_to_log_mel(complex_spectogram)
 
         features.append(mel_features)
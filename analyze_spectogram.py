@@ -1,5 +1,5 @@
 from dataset.spectogram.preprocess import multichannel_stft, multichannel_complex_to_log_mel
-from dataset.dataset_utils import read_multichannel_audio
+from dataset.dataset_utils import read_audio_segment
 from dataset.spectogram import spectogram_configs as cfg
 import matplotlib.pyplot as plt
 import numpy as np
@@ -16,10 +16,7 @@ if __name__ == '__main__':
     sec_start = 35.45
     sec_end = 35.65
 
-    multichannel_waveform = read_multichannel_audio(audio_path=audio_path, target_fs=cfg.working_sample_rate)
-
-
-    multichannel_waveform = multichannel_waveform[int(cfg.working_sample_rate * sec_start): int(cfg.working_sample_rate * sec_end)]
+    multichannel_waveform = read_audio_segment(audio_path, sec_start, sec_end, target_fs=cfg.working_sample_rate)
     soundfile.write("tmp_file.WAV", multichannel_waveform, cfg.working_sample_rate)
     feature = multichannel_stft(multichannel_waveform)
     feature = multichannel_complex_to_log_mel(feature)
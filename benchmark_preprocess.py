@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import soundfile
+
+from dataset.dataset_utils import read_multichannel_audio
+from dataset.resampling import make_resample_stream
+from dataset.spectogram import spectogram_configs as cfg
+from dataset.spectogram.feature_statistics import calculate_feature_statistics
+from dataset.spectogram.feature_store import FeatureStoreWriter
+from dataset.spectogram.preprocess import extract_features, complex_to_log_mel
+
+STAGES = ['decode', 'resample', 'stft', 'log_mel', 'statistics', 'store']
+AUDIO_EXTENSIONS = ['.wav', '.flac', '.ogg', '.aiff', '.aif']
+
+
+def collect_audio_paths(paths):
+    audio_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                audio_paths += [os.path.join(root, name) for name in sorted(file_names)
+                                if os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS]
+        else:
+            audio_paths.append(path)
+    return audio_paths
+
+
+def get_max_rss_bytes():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_stage(stage_function, trace_memory):
+    """
+    Returns the output of stage_function(), its wall time and the peak of the memory it allocated (0 if not traced).
+    The peak is measured with tracemalloc which sees numpy and python allocations but not the internal buffers of
+    torch or soxr; the process' max RSS is reported for the whole run
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    output = stage_function()
+    seconds = time.perf_counter() - start
+    peak_bytes = 0
+    if trace_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return output, seconds, peak_bytes
+
+
+def resample_in_blocks(multichannel_audio, sample_rate, block_size=2**18):
+    """
+    Resamples decoded audio to the working sample rate with the streaming resampler, block by block like
+    read_multichannel_audio_blocks does while decoding
+    """
+    if sample_rate == cfg.working_sample_rate:
+        return multichannel_audio
+    resampler = make_resample_stream(sample_rate, cfg.working_sample_rate, cfg.audio_channels,
+                                     quality=cfg.resample_quality, dtype='float32')
+    blocks = [resampler.resample_chunk(multichannel_audio[i: i + block_size], last=False)
+              for i in range(0, len(multichannel_audio), block_size)]
+    blocks.append(resampler.resample_chunk(np.zeros((0, cfg.audio_channels), dtype=np.float32), last=True))
+    return np.concatenate(blocks, axis=0)
+
+
+def preprocess_file(audio_path, writer, trace_memory=True):
+    """
+    Runs the preprocessing stages on one file (the same steps preprocess_data runs in a worker)
+    Returns:
+        {stage: (seconds, peak_bytes)}
+    """
+    results = {}
+    # The streaming decoder without target_fs keeps the file's sample rate so resampling is timed separately
+    multichannel_audio, *results['decode'] = run_stage(lambda: read_multichannel_audio(audio_path, use_cache=False),
+                                                       trace_memory)
+    sample_rate = soundfile.info(audio_path).samplerate
+    waveform, *results['resample'] = run_stage(lambda: resample_in_blocks(multichannel_audio, sample_rate),
+                                               trace_memory)
+    complex_spectogram, *results['stft'] = run_stage(lambda: extract_features(waveform, 'Complex'), trace_memory)
+    log_mel, *results['log_mel'] = run_stage(lambda: complex_to_log_mel(complex_spectogram), trace_memory)
+    statistics, *results['statistics'] = run_stage(lambda: calculate_feature_statistics(log_mel), trace_memory)
+    _, *results['store'] = run_stage(lambda: writer.add(os.path.basename(audio_path), log_mel, [], [], statistics),
+                                     trace_memory)
+    return results
+
+
+def benchmark_preprocess(audio_paths, repeats=1, trace_memory=True):
+    """
+    Returns a json serializable report of the time, throughput (audio seconds per second) and real time factor
+    (processing time / audio time) and peak traced memory of every preprocessing stage over the given files, and the
+    process' max RSS before and after preprocessing them (which unlike tracemalloc also sees torch and soxr)
+    """
+    initial_max_rss_bytes = get_max_rss_bytes()
+    store_dir = tempfile.mkdtemp(prefix='benchmark_preprocess_')
+    try:
+        # Warm up: builds the mel filter bank, the analysis window, FFT plans etc.
+        preprocess_file(audio_paths[0], FeatureStoreWriter(store_dir), trace_memory=False)
+
+        audio_seconds = 0
+        stage_seconds = {stage: 0.0 for stage in STAGES}
+        stage_peak_bytes = {stage: 0 for stage in STAGES}
+        for _ in range(repeats):
+            # A small shard size makes the store write its shard for every file
+            writer = FeatureStoreWriter(store_dir, shard_max_bytes=1)
+            for audio_path in audio_paths:
+                audio_seconds += soundfile.info(audio_path).duration
+                for stage, (seconds, peak_bytes) in preprocess_file(audio_path, writer, trace_memory).items():
+                    stage_seconds[stage] += seconds
+                    stage_peak_bytes[stage] = max(stage_peak_bytes[stage], peak_bytes)
+            writer.close()
+    finally:
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+    total_seconds = sum(stage_seconds.values())
+    stages = {}
+    for stage in STAGES + ['total']:
+        seconds = total_seconds if stage == 'total' else stage_seconds[stage]
+        stages[stage] = {'seconds': seconds,
+                         'audio_seconds_per_second': audio_seconds / seconds if seconds > 0 else None,
+                         'real_time_factor': seconds / audio_seconds,
+                         'peak_bytes': max(stage_peak_bytes.values()) if stage == 'total' else stage_peak_bytes[stage]}
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()},
+        'config': {'working_sample_rate': cfg.working_sample_rate, 'audio_channels': cfg.audio_channels,
+                   'resample_quality': cfg.resample_quality, 'frame_size': cfg.frame_size, 'hop_size': cfg.hop_size,
+                   'NFFT': cfg.NFFT, 'mel_bins': cfg.mel_bins, 'feature_frontend': cfg.feature_frontend,
+                   'fft_backend': cfg.fft_backend, 'fft_workers': cfg.fft_workers},
+        'files_num': len(audio_paths),
+        'repeats': repeats,
+        'audio_seconds': audio_seconds,
+        'stages': stages,
+        'initial_max_rss_bytes': initial_max_rss_bytes,
+        'max_rss_bytes': get_max_rss_bytes(),
+    }
+
+
+def print_report(report):
+    print(f"{report['files_num']} files x {report['repeats']} repeats, {report['audio_seconds']:.1f} audio seconds "
+          f"(frontend: {report['config']['feature_frontend']}, fft: {report['config']['fft_backend']}, "
+          f"resample: {report['config']['resample_quality']})")
+    print(f"\t{'stage':<12}{'seconds':>10}{'audio s/s':>12}{'RTF':>10}{'peak MB':>10}")
+    for stage, result in report['stages'].items():
+        throughput = result['audio_seconds_per_second']
+        print(f"\t{stage:<12}{result['seconds']:>10.3f}{throughput or float('inf'):>12.1f}"
+              f"{result['real_time_factor']:>10.5f}{result['peak_bytes'] / 2**20:>10.1f}")
+    print(f"\tmax RSS: {report['max_rss_bytes'] / 2**20:.1f}MB "
+          f"(+{(report['max_rss_bytes'] - report['initial_max_rss_bytes']) / 2**20:.1f}MB while preprocessing)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the spectogram preprocessing')
+    parser.add_argument('paths', nargs='+', help='Audio files or directories to sample the files from')
+    parser.add_argument('--num_files', type=int, default=10, help='Number of files sampled from the given paths')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--feature_frontend', type=str, default=None, help='torch or numpy; cfg.feature_frontend if not set')
+    parser.add_argument('--fft_backend', type=str, default=None, help='numpy, scipy, pyfftw or auto; cfg.fft_backend if not set')
+    parser.add_argument('--resample_quality', type=str, default=None, help='fast, hq or vhq; cfg.resample_quality if not set')
+    parser.add_argument('--no_memory', action='store_true', default=False,
+                        help='Do not trace the peak memory of the stages (tracing slows down allocations)')
+    parser.add_argument('--json', type=str, default=None, help='Append the report as a line to this json lines file')
+    args = parser.parse_args()
+
+    for name in ['feature_frontend', 'fft_backend', 'resample_quality']:
+        if getattr(args, name) is not None:
+            setattr(cfg, name, getattr(args, name))
+
+    audio_paths = collect_audio_paths(args.paths)
+    random.Random(args.seed).shuffle(audio_paths)
+    audio_paths = sorted(audio_paths[:args.num_files])
+    if not audio_paths:
+        raise ValueError(f"No audio files found in {args.paths}")
+
+    report = benchmark_preprocess(audio_paths, repeats=args.repeats, trace_memory=not args.no_memory)
+    print_report(report)
+    if args.json is not None:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(report) + '\n')
@@ -0,0 +1,91 @@
+import hashlib
+import os
+
+import numpy as np
+
+from utils.common import atomic_write
+
+
+class AudioCache:
+    """
+    A content addressed on-disk cache of decoded and resampled audio.
+    Each entry is a float32 (samples, channels) .npy file named by a hash of the source file identity (path, size,
+    mtime) and of the parameters that affect the decoded samples, so a changed source file or a different sample rate
+    simply maps to a new entry. Entries are opened as read-only memmaps and the least recently used ones are evicted
+    once the cache grows beyond max_bytes.
+    """
+    version = 2  # Bump when the decoding / resampling code changes the cached samples
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, audio_path, target_fs, audio_channels, resample_quality):
+        stat = os.stat(audio_path)
+        identity = f"{os.path.abspath(audio_path)}|{stat.st_size}|{stat.st_mtime_ns}|{target_fs}|{audio_channels}|" \
+                   f"{resample_quality}|v{self.version}"
+        return hashlib.sha1(identity.encode()).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def load(self, audio_path, target_fs, audio_channels, resample_quality, mmap_mode='r'):
+        """
+        Returns the cached audio or None if it is not cached
+        """
+        path = self.get_path(self.get_key(audio_path, target_fs, audio_channels, resample_quality))
+        try:
+            multichannel_audio = np.load(path, mmap_mode=mmap_mode)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            # e.g a read-only cache or a file evicted by another process: the loaded audio is still valid
+            pass
+        return multichannel_audio
+
+    def store(self, audio_path, target_fs, audio_channels, resample_quality, multichannel_audio):
+        path = self.get_path(self.get_key(audio_path, target_fs, audio_channels, resample_quality))
+        atomic_write(path, lambda f: np.save(f, np.ascontiguousarray(multichannel_audio, dtype=np.float32)))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+_audio_caches = {}
+
+
+def get_audio_cache(cache_dir, max_bytes):
+    """
+    Returns a process wide cache object for the given directory or None if cache_dir is None (caching disabled)
+    """
+    if cache_dir is None:
+        return None
+    if cache_dir not in _audio_caches:
+        _audio_caches[cache_dir] = AudioCache(cache_dir, max_bytes)
+    audio_cache = _audio_caches[cache_dir]
+    audio_cache.max_bytes = max_bytes
+    return audio_cache
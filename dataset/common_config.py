@@ -1,3 +1,4 @@
+import os
 
 time_margin = 0.33
 working_sample_rate = 48000
@@ -6,6 +7,15 @@ hop_size = frame_size // 2
 audio_channels = 1
 min_event_percentage_in_positive_frame = 0.74
 frames_per_second = working_sample_rate // hop_size
+audio_storage_dtype = 'float32'  # In-memory dtype of training waveforms: 'float32' or 'int16' (PCM16 decoded per crop)
+resample_quality = 'hq'  # 'fast' (cached polyphase filters), 'hq' or 'vhq' (soxr); see dataset/resampling.py
+
+cache_root = os.path.join(os.path.expanduser('~'), '.cache', 'SoundEventDetection')
+# Decoded and resampled audio can be cached as float32 .npy files in a directory, e.g os.path.join(cache_root, 'audio')
+# (None disables the cache)
+audio_cache_dir = None
+audio_cache_max_bytes = 10 * 2**30  # Least recently used files are evicted above this size
+constants_cache_dir = os.path.join(cache_root, 'constants')  # Memoized mel filter banks (None disables)
 
 # Tau-SED details:
 # tau_sed_labels = ['knock', 'drawer', 'clearthroat', 'phone', 'keysDrop', 'speech',
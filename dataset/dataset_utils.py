@@ -2,23 +2,28 @@ import os
 import json
 from collections import defaultdict
 
-import librosa
 import numpy as np
 import pandas as pd
 import soundfile
 
+from dataset.audio_cache import get_audio_cache
+from dataset.resampling import make_resample_stream, get_resample_input_range, resample_range
 from dataset.spectogram import spectogram_configs as cfg
 
+FILM_CLAP_LABELS_FILE = 'paths_and_labels_fixed_Meron.txt'
+
 
 def get_film_clap_paths_and_labels(data_root, time_margin=0.1):
     """
     Parses the Film_clap raw data and collect audio file paths , start_times and end_times of claps
+    Returns:
+        list of (audio_path, start_times, end_times, audio_name, class_ids); claps are class 0
     """
     result = []
     num_claps = 0
     num_audio_files = 0
     files_per_film = defaultdict(lambda:0)
-    path_to_label = json.load(open(os.path.join(data_root, 'paths_and_labels_fixed_Meron.txt')))
+    path_to_label = json.load(open(os.path.join(data_root, FILM_CLAP_LABELS_FILE)))
     print("Collecting Film-clap dataset")
     for sound_path in path_to_label:
         soundfile_name = os.path.splitext(os.path.basename(sound_path))[0]
@@ -28,7 +33,7 @@ def get_film_clap_paths_and_labels(data_root, time_margin=0.1):
         assert os.path.exists(sound_path), sound_path
         start_times = [e - time_margin for e in evemt_centers_list]
         end_times = [e + time_margin for e in evemt_centers_list]
-        result += [(sound_path, start_times, end_times, name)]
+        result += [(sound_path, start_times, end_times, name, np.zeros(len(start_times), dtype=np.int64))]
         num_claps += len(start_times)
         num_audio_files += 1
         files_per_film[film_name] += 1
@@ -41,7 +46,10 @@ def get_film_clap_paths_and_labels(data_root, time_margin=0.1):
 
 def get_tau_sed_paths_and_labels(audio_dir, labels_data_dir):
     """
-    Parses the Tau_sed raw data and collect audio file paths, start_times and end_times of claps
+    Parses the Tau_sed raw data and collect audio file paths, start_times, end_times and classes of the events of the
+    classes in cfg.tau_sed_labels
+    Returns:
+        list of (audio_path, start_times, end_times, audio_name, class_ids); class ids index cfg.tau_sed_labels
     """
     results = []
     for audio_fname in os.listdir(audio_dir):
@@ -54,33 +62,229 @@ def get_tau_sed_paths_and_labels(audio_dir, labels_data_dir):
                             if df['sound_event_recording'].values[i] in cfg.tau_sed_labels]
 
         start_times, end_times = df['start_time'].values[relevant_classes], df['end_time'].values[relevant_classes]
+        class_ids = np.array([cfg.tau_sed_labels.index(label)
+                              for label in df['sound_event_recording'].values[relevant_classes]], dtype=np.int64)
 
-        results += [(audio_path, start_times, end_times, bare_name)]
+        results += [(audio_path, start_times, end_times, bare_name, class_ids)]
 
     return results
 
 
-def read_multichannel_audio(audio_path, target_fs=None):
+def rasterize_events(length, starts, ends, class_ids=None, classes_num=1):
+    """
+    Creates a (length, classes_num) uint8 matrix with 1 in the rows [starts[i], ends[i]) of column class_ids[i] and 0
+    elsewhere. Intervals are clipped to [0, length). All events are rasterized at once from a difference array:
+    +1 at the start and -1 at the end of each event, the cumulative sum counts the events covering each row.
+    Args:
+        starts, ends: integer row indices of the events
+        class_ids: class of each event; all events are of class 0 if None
     """
-    Read the audio samples in files and resample them to fit the desired sample ratre
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, length)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), 0, length)
+    class_ids = np.zeros(len(starts), dtype=np.int64) if class_ids is None else np.asarray(class_ids, dtype=np.int64)
+    valid = starts < ends
+    differences = np.zeros((length + 1, classes_num), dtype=np.int32)
+    np.add.at(differences, (starts[valid], class_ids[valid]), 1)
+    np.add.at(differences, (ends[valid], class_ids[valid]), -1)
+    return (np.cumsum(differences[:-1], axis=0) > 0).astype(np.uint8)
+
+
+class EventIntervals:
+    """
+    Events of a timeline as [start, end) intervals of integer indices and their classes, sorted by start. Labels are
+    rasterized only for the requested windows so their memory scales with the number of events rather than the length
+    of the timeline.
+    """
+    def __init__(self, starts, ends, class_ids=None):
+        starts = np.asarray(starts, dtype=np.int64)
+        order = np.argsort(starts, kind='stable')
+        self.starts = starts[order]
+        self.ends = np.asarray(ends, dtype=np.int64)[order]
+        self.class_ids = np.zeros(len(starts), dtype=np.int64) if class_ids is None else \
+            np.asarray(class_ids, dtype=np.int64)[order]
+        # Running max of the ends: all the events before the first one whose running max exceeds an index end before it
+        self.max_ends = np.maximum.accumulate(self.ends) if len(self.ends) else self.ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def get_window_events(self, window_starts, window_end):
+        """
+        Binary searches the range [first, last) of the events that may overlap each window [window_starts, window_end)
+        """
+        first = np.searchsorted(self.max_ends, window_starts, side='right')
+        last = np.searchsorted(self.starts, window_end, side='left')
+        return first, np.maximum(first, last)
+
+    def is_covered(self, index):
+        first, last = self.get_window_events(index, index + 1)
+        return np.any(self.ends[first: last] > index)
+
+    def covered_length(self):
+        """
+        Number of indices covered by at least one event
+        """
+        if len(self) == 0:
+            return 0
+        previous_max_ends = np.concatenate(([self.starts[0]], self.max_ends[:-1]))
+        return int(np.sum(np.maximum(self.ends - np.maximum(self.starts, previous_max_ends), 0)))
+
+    def rasterize_windows(self, window_starts, window_size, classes_num=1):
+        """
+        (len(window_starts), window_size, classes_num) uint8 labels (see rasterize_events) of the windows
+        [window_starts[i], window_starts[i] + window_size)
+        """
+        window_starts = np.asarray(window_starts, dtype=np.int64)
+        first, last = self.get_window_events(window_starts, window_starts + window_size)
+        counts = last - first
+        window_indices = np.repeat(np.arange(len(window_starts)), counts)
+        event_indices = np.arange(counts.sum()) + np.repeat(first - (np.cumsum(counts) - counts), counts)
+
+        # Rasterize all windows at once as consecutive segments of window_size + 1 indices of a single timeline; the
+        # last index of a segment is never covered as the events are clipped to their window
+        offsets = window_starts[window_indices]
+        segment_offsets = window_indices * (window_size + 1)
+        starts = np.clip(self.starts[event_indices] - offsets, 0, window_size) + segment_offsets
+        ends = np.clip(self.ends[event_indices] - offsets, 0, window_size) + segment_offsets
+        labels = rasterize_events(len(window_starts) * (window_size + 1), starts, ends, self.class_ids[event_indices],
+                                  classes_num)
+        return np.ascontiguousarray(labels.reshape(len(window_starts), window_size + 1, classes_num)[:, :window_size])
+
+
+def fit_audio_channels(multichannel_audio):
+    """
+    Downmix, duplicate or drop channels of a (samples, channels) array so that it has cfg.audio_channels channels
     """
-    (multichannel_audio, sample_rate) = soundfile.read(audio_path)
-    if len(multichannel_audio.shape) == 1:
-        multichannel_audio = multichannel_audio.reshape(-1, 1)
     if multichannel_audio.shape[1] < cfg.audio_channels:
-        print(multichannel_audio.shape[1])
         multichannel_audio = np.repeat(multichannel_audio.mean(1).reshape(-1, 1), cfg.audio_channels, axis=1)
     elif cfg.audio_channels == 1:
         multichannel_audio = multichannel_audio.mean(1).reshape(-1, 1)
     elif multichannel_audio.shape[1] > cfg.audio_channels:
         multichannel_audio = multichannel_audio[:, :cfg.audio_channels]
 
-    if target_fs is not None and sample_rate != target_fs:
+    return np.ascontiguousarray(multichannel_audio)
+
+
+def read_multichannel_audio_blocks(audio_path, target_fs=None, block_size=2**18):
+    """
+    Read the audio file block by block and yield (samples, channels) chunks already downmixed and resampled to the
+    desired sample rate. The resampler keeps its filter state between blocks so concatenating the yielded chunks gives
+    the same signal as resampling the entire file at once while only one block is held in memory.
+    Args:
+        block_size: number of frames (in the original sample rate) read from the file at once
+    """
+    with soundfile.SoundFile(audio_path) as f:
+        resampler = None
+        if target_fs is not None and f.samplerate != target_fs:
+            resampler = make_resample_stream(f.samplerate, target_fs, cfg.audio_channels, quality=cfg.resample_quality,
+                                             dtype='float32')
+
+        for block in f.blocks(blocksize=block_size, always_2d=True, dtype='float32'):
+            block = fit_audio_channels(block)
+            if resampler is not None:
+                block = resampler.resample_chunk(block, last=False)
+            if len(block) > 0:
+                yield block
+
+        if resampler is not None:
+            # Flush the samples still held by the resampler's filter
+            block = resampler.resample_chunk(np.zeros((0, cfg.audio_channels), dtype=np.float32), last=True)
+            if len(block) > 0:
+                yield block
+
+
+def read_multichannel_audio(audio_path, target_fs=None, use_cache=True):
+    """
+    Read the audio samples in files and resample them to fit the desired sample ratre. Samples are float32.
+    When the audio cache is enabled (cfg.audio_cache_dir) the decoded audio is stored on disk and later calls
+    return a read-only memmap of it instead of decoding and resampling the file again.
+    """
+    audio_cache = get_audio_cache(cfg.audio_cache_dir, cfg.audio_cache_max_bytes) if use_cache else None
+    if audio_cache is not None:
+        multichannel_audio = audio_cache.load(audio_path, target_fs, cfg.audio_channels, cfg.resample_quality)
+        if multichannel_audio is not None:
+            return multichannel_audio
+
+    multichannel_audio = _decode_multichannel_audio(audio_path, target_fs)
+
+    if audio_cache is not None:
+        audio_cache.store(audio_path, target_fs, cfg.audio_channels, cfg.resample_quality, multichannel_audio)
+
+    return multichannel_audio
 
-        channels_num = multichannel_audio.shape[1]
 
-        multichannel_audio = np.array(
-            [librosa.resample(multichannel_audio[:, i], orig_sr=sample_rate, target_sr=target_fs) for i in range(channels_num)]
-        ).T
+def _decode_multichannel_audio(audio_path, target_fs):
+    blocks = list(read_multichannel_audio_blocks(audio_path, target_fs=target_fs))
+    multichannel_audio = np.concatenate(blocks, axis=0) if blocks else np.zeros((0, cfg.audio_channels), dtype=np.float32)
+
+    if target_fs is not None:
+        # Keep the output length librosa.resample used to produce (ceil of the float ratio)
+        info = soundfile.info(audio_path)
+        if info.samplerate != target_fs:
+            length = int(np.ceil(info.frames * (target_fs / info.samplerate)))
+            multichannel_audio = _fix_length(multichannel_audio, length)
 
     return multichannel_audio
+
+
+def read_audio_segment(audio_path, start_s, end_s, target_fs=None):
+    """
+    Read only the [start_s, end_s) time range of an audio file.
+    Seeks to the needed frames plus the padding the resampler's filter needs so that the result equals the same
+    samples of read_multichannel_audio(audio_path, target_fs) without decoding the rest of the file.
+    """
+    with soundfile.SoundFile(audio_path) as f:
+        if target_fs is None or f.samplerate == target_fs:
+            sample_rate = f.samplerate
+            first_frame, last_frame = _time_range_to_samples(start_s, end_s, sample_rate, f.frames)
+            return fit_audio_channels(_read_frames(f, first_frame, last_frame))
+
+        # Same length read_multichannel_audio returns
+        total_out = int(np.ceil(f.frames * (target_fs / f.samplerate)))
+        first_out, last_out = _time_range_to_samples(start_s, end_s, target_fs, total_out)
+        first_in, last_in = get_resample_input_range(first_out, last_out, f.samplerate, target_fs, cfg.resample_quality)
+        audio_segment = fit_audio_channels(_read_frames(f, first_in, min(last_in, f.frames)))
+
+        return resample_range(audio_segment, first_in, first_out, last_out, f.samplerate, target_fs,
+                              quality=cfg.resample_quality)
+
+
+def _time_range_to_samples(start_s, end_s, sample_rate, num_samples):
+    first_sample = min(max(int(sample_rate * start_s), 0), num_samples)
+    last_sample = min(max(int(sample_rate * end_s), first_sample), num_samples)
+    return first_sample, last_sample
+
+
+def _read_frames(sound_file, first_frame, last_frame):
+    sound_file.seek(first_frame)
+    return sound_file.read(last_frame - first_frame, dtype='float32', always_2d=True)
+
+
+def _fix_length(multichannel_audio, length):
+    if len(multichannel_audio) >= length:
+        return multichannel_audio[:length]
+    padding = np.zeros((length - len(multichannel_audio), multichannel_audio.shape[1]), dtype=multichannel_audio.dtype)
+    return np.concatenate((multichannel_audio, padding), axis=0)
+
+
+def encode_audio_samples(multichannel_audio, dtype):
+    """
+    Convert float audio to the sample storage dtype.
+    Returns the encoded samples and the scale factor decode_audio_samples needs to restore them
+    """
+    if np.dtype(dtype) == np.int16:
+        scale = 1 / 32768
+        samples = np.clip(np.round(multichannel_audio / scale), -32768, 32767).astype(np.int16)
+    else:
+        scale = 1.0
+        samples = np.asarray(multichannel_audio, dtype=dtype)
+    return samples, scale
+
+
+def decode_audio_samples(samples, scale):
+    """
+    Return float32 samples out of stored ones (see encode_audio_samples)
+    """
+    if samples.dtype == np.int16:
+        return samples.astype(np.float32) * np.float32(scale)
+    return samples.astype(np.float32)
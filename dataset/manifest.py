@@ -0,0 +1,138 @@
+import json
+import os
+
+import numpy as np
+import soundfile
+
+from utils.common import atomic_write
+
+
+def read_audio_header(audio_path):
+    """
+    Read the format of an audio file from its header only, without decoding any sample
+    """
+    stat = os.stat(audio_path)
+    info = soundfile.info(audio_path)
+    return {'sample_rate': info.samplerate,
+            'channels': info.channels,
+            'frames': info.frames,
+            'duration': info.frames / info.samplerate,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size}
+
+
+def build_manifest(audio_paths_and_labels, manifest_path=None, label_params=None):
+    """
+    Creates a table with the path, name, header info (sample_rate, channels, frames, duration, mtime, size) and
+    labels of every audio file in the dataset.
+    If manifest_path exists, headers of files whose size and mtime did not change are taken from it, so refreshing the
+    manifest after adding files only reads the headers of the new ones. Files missing from audio_paths_and_labels are
+    dropped. The updated manifest is written back to manifest_path.
+    Args:
+        audio_paths_and_labels: list of (audio_path, start_times, end_times, audio_name, class_ids) as returned by the
+            get_*_paths_and_labels functions
+        label_params: parameters the labels were parsed with (e.g the time margin), see load_manifest_if_current
+    """
+    known_headers = {}
+    if manifest_path is not None and os.path.exists(manifest_path):
+        old_manifest = load_manifest(manifest_path)
+        for i, path in enumerate(old_manifest['path']):
+            known_headers[path] = {key: old_manifest[key][i].item() for key in
+                                   ['sample_rate', 'channels', 'frames', 'duration', 'mtime', 'size']}
+
+    headers = []
+    for (audio_path, start_times, end_times, audio_name, class_ids) in audio_paths_and_labels:
+        header = known_headers.get(audio_path)
+        stat = os.stat(audio_path)
+        if header is None or header['mtime'] != stat.st_mtime_ns or header['size'] != stat.st_size:
+            header = read_audio_header(audio_path)
+        headers.append(header)
+
+    event_counts = [len(start_times) for (_, start_times, _, _, _) in audio_paths_and_labels]
+    manifest = {
+        'path': np.array([x[0] for x in audio_paths_and_labels], dtype=str),
+        'name': np.array([x[3] for x in audio_paths_and_labels], dtype=str),
+        'sample_rate': np.array([h['sample_rate'] for h in headers], dtype=np.int32),
+        'channels': np.array([h['channels'] for h in headers], dtype=np.int16),
+        'frames': np.array([h['frames'] for h in headers], dtype=np.int64),
+        'duration': np.array([h['duration'] for h in headers], dtype=np.float64),
+        'mtime': np.array([h['mtime'] for h in headers], dtype=np.int64),
+        'size': np.array([h['size'] for h in headers], dtype=np.int64),
+        # Labels of file i are start_times/end_times/class_ids[event_offsets[i]: event_offsets[i+1]]
+        'event_offsets': np.concatenate(([0], np.cumsum(event_counts))).astype(np.int64),
+        'start_times': np.concatenate([np.asarray(x[1], dtype=np.float64) for x in audio_paths_and_labels] + [[]]),
+        'end_times': np.concatenate([np.asarray(x[2], dtype=np.float64) for x in audio_paths_and_labels] + [[]]),
+        'class_ids': np.concatenate([np.asarray(x[4], dtype=np.int64) for x in audio_paths_and_labels] +
+                                    [np.zeros(0, dtype=np.int64)]),
+        'label_params': np.array(json.dumps(label_params or {}, sort_keys=True)),
+    }
+
+    if manifest_path is not None:
+        save_manifest(manifest, manifest_path)
+
+    return manifest
+
+
+def save_manifest(manifest, manifest_path):
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    atomic_write(manifest_path, lambda f: np.savez(f, **manifest))
+
+
+def load_manifest(manifest_path):
+    with np.load(manifest_path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+
+def load_manifest_if_current(manifest_path, source_paths, label_params=None):
+    """
+    Returns the manifest saved in manifest_path if it was built with the same label_params after the last modification
+    of every source path and the size and mtime of each of its audio files are still the recorded ones, None
+    otherwise. The source paths are the label files and the audio directories (adding or removing a file changes the
+    modification time of its directory), so a current manifest replaces parsing the labels and reading the audio
+    headers of the dataset; a re-exported or replaced audio file only costs a stat to detect.
+    """
+    if not os.path.exists(manifest_path):
+        return None
+    manifest_mtime = os.stat(manifest_path).st_mtime_ns
+    if any(os.stat(path).st_mtime_ns > manifest_mtime for path in source_paths):
+        return None
+    manifest = load_manifest(manifest_path)
+    if 'label_params' not in manifest or str(manifest['label_params']) != json.dumps(label_params or {}, sort_keys=True):
+        return None
+    for path, mtime, size in zip(manifest['path'], manifest['mtime'], manifest['size']):
+        try:
+            stat = os.stat(str(path))
+        except OSError:
+            return None
+        if stat.st_mtime_ns != mtime or stat.st_size != size:
+            return None
+    return manifest
+
+
+def manifest_to_paths_and_labels(manifest):
+    """
+    Returns the manifest in the (audio_path, start_times, end_times, audio_name, class_ids) list format of the datasets
+    """
+    offsets = manifest['event_offsets']
+    return [(str(manifest['path'][i]),
+             manifest['start_times'][offsets[i]: offsets[i + 1]],
+             manifest['end_times'][offsets[i]: offsets[i + 1]],
+             str(manifest['name'][i]),
+             manifest['class_ids'][offsets[i]: offsets[i + 1]]) for i in range(len(manifest['path']))]
+
+
+def estimate_waveform_bytes(manifest, target_fs, audio_channels, dtype=np.float32):
+    """
+    Memory needed to hold the whole dataset as resampled waveforms of the given dtype
+    """
+    samples = np.ceil(manifest['frames'] * (target_fs / manifest['sample_rate'].astype(np.float64)))
+    return int(samples.sum()) * audio_channels * np.dtype(dtype).itemsize
+
+
+def print_manifest_summary(manifest, target_fs, audio_channels, dtype=np.float32):
+    sample_rates, counts = np.unique(manifest['sample_rate'], return_counts=True)
+    print(f"\tManifest: {len(manifest['path'])} audio files, {manifest['duration'].sum() / 3600:.2f} hours, "
+          f"{len(manifest['start_times'])} events")
+    print(f"\t- Sample rates: {', '.join(f'{sr}Hz x {c}' for sr, c in zip(sample_rates, counts))}")
+    print(f"\t- Estimated waveform memory at {target_fs}Hz, {audio_channels} channels, {np.dtype(dtype).name}: "
+          f"{estimate_waveform_bytes(manifest, target_fs, audio_channels, dtype) / 2**30:.2f}GB")
@@ -0,0 +1,237 @@
+import argparse
+import time
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+import soxr
+from scipy.signal import firwin, upfirdn
+
+# fast: Rational polyphase FIR filter (same filter as scipy.signal.resample_poly). Filters are cached per rate pair and
+#       any range of output samples can be computed exactly from a slice of the input (see resample_poly_range).
+# hq:   soxr high quality, the resampler librosa.resample uses by default.
+# vhq:  soxr very high quality.
+RESAMPLE_QUALITIES = ['fast', 'hq', 'vhq']
+SOXR_SEGMENT_PADDING = 512  # Input samples added on each side of a segment (more when downsampling) for soxr to be edge exact
+
+
+@lru_cache(maxsize=None)
+def get_polyphase_filter(orig_sr, target_sr):
+    """
+    Returns (up, down, h): the reduced rational ratio and the anti aliasing filter of scipy.signal.resample_poly
+    (already multiplied by 'up'). Designing the filter costs more than applying it on short signals so it is cached.
+    """
+    g = gcd(int(orig_sr), int(target_sr))
+    up, down = int(target_sr) // g, int(orig_sr) // g
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0)) * up
+    h.setflags(write=False)
+    return up, down, h
+
+
+def get_resampled_length(num_samples, orig_sr, target_sr):
+    up, down, _ = get_polyphase_filter(orig_sr, target_sr)
+    return -(-num_samples * up // down)
+
+
+def resample_poly_range(audio_segment, segment_start, first_out, last_out, orig_sr, target_sr):
+    """
+    Computes the output samples [first_out, last_out) of the polyphase resampling of a long signal x given only
+    audio_segment = x[segment_start: segment_start + len(audio_segment)].
+    Input samples outside the segment are treated as zeros, so the result is exact as long as the segment covers the
+    filter support of the requested outputs (or reaches the signal edges, where resample_poly zero pads as well).
+    Args:
+        audio_segment: (samples, channels) array
+    """
+    up, down, h = get_polyphase_filter(orig_sr, target_sr)
+    half_len = (len(h) - 1) // 2
+    # upfirdn output m of the segment is output n = m + first_upfirdn_out of the full signal once the filter is
+    # delayed by 'filter_delay' samples
+    first_upfirdn_out = (segment_start * up - half_len) // down
+    filter_delay = segment_start * up - half_len - first_upfirdn_out * down
+    h = np.concatenate((np.zeros(filter_delay), h))
+
+    resampled = upfirdn(h, audio_segment, up, down, axis=0)
+    resampled = resampled[max(first_out - first_upfirdn_out, 0): max(last_out - first_upfirdn_out, 0)]
+
+    missing_samples = (last_out - first_out) - len(resampled)
+    if missing_samples > 0:  # Outputs beyond the end of the segment only see zero inputs
+        resampled = np.concatenate((resampled, np.zeros((missing_samples,) + resampled.shape[1:])), axis=0)
+
+    return resampled.astype(audio_segment.dtype, copy=False)
+
+
+class PolyphaseResampleStream:
+    """
+    Resamples a signal given in consecutive chunks with the cached polyphase filter. Has the same interface as
+    soxr.ResampleStream and concatenating its outputs gives exactly scipy.signal.resample_poly of the whole signal.
+    """
+    def __init__(self, orig_sr, target_sr, num_channels, dtype='float32'):
+        self.orig_sr = orig_sr
+        self.target_sr = target_sr
+        self.up, self.down, h = get_polyphase_filter(orig_sr, target_sr)
+        self.half_len = (len(h) - 1) // 2
+        self.buffer = np.zeros((0, num_channels), dtype=dtype)
+        self.buffer_start = 0  # Index of the first buffered input sample
+        self.total_in = 0
+        self.next_out = 0
+
+    def resample_chunk(self, chunk, last=False):
+        self.buffer = np.concatenate((self.buffer, chunk.astype(self.buffer.dtype, copy=False)), axis=0)
+        self.total_in += len(chunk)
+
+        if last:
+            end_out = -(-self.total_in * self.up // self.down)
+        else:
+            # Last output whose filter support ends before the first unseen input sample
+            end_out = (self.total_in * self.up - 1 - self.half_len) // self.down + 1
+        end_out = max(end_out, self.next_out)
+
+        resampled = resample_poly_range(self.buffer, self.buffer_start, self.next_out, end_out,
+                                        self.orig_sr, self.target_sr)
+        self.next_out = end_out
+
+        # Drop inputs that no future output depends on
+        first_needed_input = max(-(-(end_out * self.down - self.half_len) // self.up), 0)
+        drop = min(max(first_needed_input - self.buffer_start, 0), len(self.buffer))
+        self.buffer = self.buffer[drop:]
+        self.buffer_start += drop
+
+        return resampled
+
+
+def resample_multichannel(multichannel_audio, orig_sr, target_sr, quality='hq'):
+    """
+    Resample all channels of a (samples, channels) array in one vectorized call
+    """
+    assert quality in RESAMPLE_QUALITIES, f"Resample quality should be one of {RESAMPLE_QUALITIES}"
+    if orig_sr == target_sr:
+        return multichannel_audio
+    if quality == 'fast':
+        return resample_poly_range(multichannel_audio, 0, 0, get_resampled_length(len(multichannel_audio), orig_sr, target_sr),
+                                   orig_sr, target_sr)
+    else:
+        return soxr.resample(multichannel_audio, orig_sr, target_sr, quality=quality.upper())
+
+
+def make_resample_stream(orig_sr, target_sr, num_channels, quality='hq', dtype='float64'):
+    """
+    Returns a stateful resampler with a resample_chunk(chunk, last) method for the desired quality
+    """
+    assert quality in RESAMPLE_QUALITIES, f"Resample quality should be one of {RESAMPLE_QUALITIES}"
+    if quality == 'fast':
+        return PolyphaseResampleStream(orig_sr, target_sr, num_channels, dtype=dtype)
+    else:
+        return soxr.ResampleStream(orig_sr, target_sr, num_channels, dtype=dtype, quality=quality.upper())
+
+
+def get_resample_input_range(first_out, last_out, orig_sr, target_sr, quality='hq'):
+    """
+    Returns the range [first_in, last_in) of input samples needed by resample_range to compute the output samples
+    [first_out, last_out). last_in may exceed the signal length and should be clipped by the caller.
+    """
+    up, down, h = get_polyphase_filter(orig_sr, target_sr)
+    if quality == 'fast':
+        # Exactly the support of the polyphase filter of the first and last outputs
+        half_len = (len(h) - 1) // 2
+        first_in = -(-(first_out * down - half_len) // up)
+        last_in = ((last_out - 1) * down + half_len) // up + 1
+    else:
+        # soxr filters are not exposed so pad with a margin that is longer than their (HQ / VHQ) impulse response.
+        # first_in is aligned to a multiple of 'down' so that it falls exactly on an output sample.
+        padding = int(SOXR_SEGMENT_PADDING * max(1., orig_sr / target_sr))
+        first_in = (first_out * down // up - padding) // down * down
+        last_in = -(-last_out * down // up) + padding
+    return max(first_in, 0), last_in
+
+
+def resample_range(audio_segment, segment_start, first_out, last_out, orig_sr, target_sr, quality='hq'):
+    """
+    Computes the output samples [first_out, last_out) of resampling a long signal given only the input samples
+    [segment_start, segment_start + len(audio_segment)) as returned by get_resample_input_range.
+    The result matches resampling the whole signal exactly for the 'fast' tier and up to float precision for soxr.
+    """
+    assert quality in RESAMPLE_QUALITIES, f"Resample quality should be one of {RESAMPLE_QUALITIES}"
+    if quality == 'fast':
+        return resample_poly_range(audio_segment, segment_start, first_out, last_out, orig_sr, target_sr)
+
+    up, down, _ = get_polyphase_filter(orig_sr, target_sr)
+    assert segment_start % down == 0, "soxr segments should start on an output sample"
+    segment_first_out = segment_start * up // down
+    resampled = soxr.resample(audio_segment, orig_sr, target_sr, quality=quality.upper())
+    resampled = resampled[first_out - segment_first_out: last_out - segment_first_out]
+
+    missing_samples = (last_out - first_out) - len(resampled)
+    if missing_samples > 0:  # Outputs beyond the end of the signal
+        resampled = np.concatenate((resampled, np.zeros((missing_samples,) + resampled.shape[1:], dtype=resampled.dtype)), axis=0)
+
+    return resampled
+
+
+def _librosa_resample(multichannel_audio, orig_sr, target_sr):
+    """
+    The per channel librosa resampling read_multichannel_audio used to do
+    """
+    import librosa
+    return np.array([librosa.resample(multichannel_audio[:, i], orig_sr=orig_sr, target_sr=target_sr)
+                     for i in range(multichannel_audio.shape[1])]).T
+
+
+def _spectral_error_db(signal, reference, sample_rate, max_freq):
+    """
+    Mean and max absolute difference (dB) between the power spectral densities of two signals below max_freq
+    """
+    from scipy.signal import welch
+    n = min(len(signal), len(reference))
+    freqs, signal_psd = welch(signal[:n], fs=sample_rate, nperseg=4096, axis=0)
+    _, reference_psd = welch(reference[:n], fs=sample_rate, nperseg=4096, axis=0)
+    band = (freqs > 20) & (freqs < max_freq)
+    diff = np.abs(10 * np.log10(signal_psd[band] + 1e-20) - 10 * np.log10(reference_psd[band] + 1e-20))
+    return diff.mean(), diff.max()
+
+
+def benchmark(audio_paths, target_sr, duration=60, orig_sr=44100, channels=2):
+    """
+    Reports the real time factor (processing time / audio time) of every quality tier and the spectral error of its
+    output against the librosa.resample output used so far
+    """
+    import soundfile
+    signals = []
+    if audio_paths:
+        for path in audio_paths:
+            multichannel_audio, sample_rate = soundfile.read(path, dtype='float32', always_2d=True)
+            signals.append((path, multichannel_audio, sample_rate))
+    else:
+        # Pink-ish noise so that the whole spectrum is exercised
+        white = np.random.randn(int(orig_sr * duration), channels)
+        signals.append(('synthetic', np.cumsum(white, axis=0) * 0.001 + white * 0.1, orig_sr))
+
+    for name, multichannel_audio, sample_rate in signals:
+        multichannel_audio = multichannel_audio.astype(np.float32)
+        audio_seconds = len(multichannel_audio) / sample_rate
+        print(f"{name}: {multichannel_audio.shape[1]} channels, {audio_seconds:.1f}s, {sample_rate} -> {target_sr}")
+
+        start = time.time()
+        reference = _librosa_resample(multichannel_audio, sample_rate, target_sr)
+        print(f"\tlibrosa (per channel): RTF {(time.time() - start) / audio_seconds:.5f}")
+
+        for quality in RESAMPLE_QUALITIES:
+            resample_multichannel(multichannel_audio[:sample_rate], sample_rate, target_sr, quality)  # Warm up caches
+            start = time.time()
+            resampled = resample_multichannel(multichannel_audio, sample_rate, target_sr, quality)
+            rtf = (time.time() - start) / audio_seconds
+            mean_error, max_error = _spectral_error_db(resampled, reference, target_sr,
+                                                       0.9 * min(sample_rate, target_sr) / 2)
+            print(f"\t{quality}: RTF {rtf:.5f}, spectral error vs librosa: mean {mean_error:.3f}dB max {max_error:.3f}dB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the resampling quality tiers')
+    parser.add_argument('audio_paths', nargs='*', help='Audio files to resample; synthetic noise if none given')
+    parser.add_argument('--target_sr', type=int, default=48000)
+    parser.add_argument('--orig_sr', type=int, default=44100, help='Sample rate of the synthetic signal')
+    parser.add_argument('--duration', type=float, default=60, help='Length in seconds of the synthetic signal')
+    args = parser.parse_args()
+
+    benchmark(args.audio_paths, args.target_sr, duration=args.duration, orig_sr=args.orig_sr)
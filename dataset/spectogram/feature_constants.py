@@ -0,0 +1,71 @@
+import hashlib
+import os
+from functools import lru_cache
+from importlib.metadata import version
+
+import numpy as np
+
+import dataset.spectogram.spectogram_configs as cfg
+from dataset.spectogram.mel_filter_bank import CroppedMelFilterBank
+from utils.common import atomic_write
+
+# Constants derived from the spectogram configuration (analysis window, mel filter bank) are built on first use rather
+# than at import time, so importing the preprocessing code (in every entry point and every spawned DataLoader worker)
+# doesn't pay for them. The mel filter bank is also memoized on disk in cfg.constants_cache_dir.
+
+
+def get_mel_params():
+    """
+    The configuration values the mel filter bank depends on
+    """
+    return cfg.working_sample_rate, cfg.NFFT, cfg.mel_bins, cfg.mel_min_freq, cfg.mel_max_freq
+
+
+@lru_cache(maxsize=None)
+def get_analysis_window(frame_size=None):
+    window = np.hanning(frame_size or cfg.frame_size)
+    window.setflags(write=False)
+    return window
+
+
+def get_mel_filter_bank_matrix(mel_params=None):
+    """
+    Dense (NFFT // 2 + 1, mel_bins) mel filter bank matrix
+    Args:
+        mel_params: (sample_rate, n_fft, mel_bins, fmin, fmax); taken from the configuration if None
+    """
+    return _get_mel_filter_bank_matrix(tuple(mel_params or get_mel_params()))
+
+
+def get_mel_filter_bank(mel_params=None):
+    """
+    get_mel_filter_bank_matrix(mel_params) cropped to its support (see CroppedMelFilterBank)
+    """
+    return _get_mel_filter_bank(tuple(mel_params or get_mel_params()))
+
+
+@lru_cache(maxsize=None)
+def _get_mel_filter_bank(mel_params):
+    return CroppedMelFilterBank(get_mel_filter_bank_matrix(mel_params))
+
+
+@lru_cache(maxsize=None)
+def _get_mel_filter_bank_matrix(mel_params):
+    cache_path = None
+    if cfg.constants_cache_dir is not None:
+        key = hashlib.sha1(f"mel|{'|'.join(map(str, mel_params))}|librosa-{version('librosa')}".encode()).hexdigest()
+        cache_path = os.path.join(cfg.constants_cache_dir, f"mel_filter_bank_{key}.npy")
+        try:
+            return np.load(cache_path)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    import librosa
+    sample_rate, n_fft, mel_bins, fmin, fmax = mel_params
+    mel_filter_bank_matrix = librosa.filters.mel(sr=sample_rate, n_fft=n_fft, n_mels=mel_bins, fmin=fmin, fmax=fmax).T
+
+    if cache_path is not None:
+        os.makedirs(cfg.constants_cache_dir, exist_ok=True)
+        atomic_write(cache_path, lambda f: np.save(f, mel_filter_bank_matrix))
+
+    return mel_filter_bank_matrix
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+from importlib.metadata import version
+
+import dataset.spectogram.spectogram_configs as cfg
+from dataset.spectogram.feature_constants import get_mel_params
+from utils.common import atomic_write
+
+# Preprocessed features are cached in directories named by a hash of every parameter they depend on (see
+# get_feature_params) rather than by cfg.cfg_descriptor, so a cache directory can be shared by runs and machines and
+# a change of any parameter (or of the preprocessing code, see FEATURES_VERSION) never reuses stale features.
+
+# Increase when a change of the preprocessing code changes the features it produces
+FEATURES_VERSION = 1
+PARAMS_FILE_NAME = 'params.json'
+
+
+def get_feature_params(preprocess_mode, mel_params=None, storage_dtype=None, **label_params):
+    """
+    The complete set of parameters the preprocessed features of a data set depend on
+    Args:
+        mel_params: (sample_rate, n_fft, mel_bins, fmin, fmax); the configuration's if None
+        storage_dtype: as in get_feature_config
+        label_params: parameters of the data set's labels (e.g the classes or time margin used to parse them)
+    """
+    sample_rate, n_fft, mel_bins, mel_min_freq, mel_max_freq = mel_params or get_mel_params()
+    if storage_dtype is None and preprocess_mode == 'Complex':
+        storage_dtype = cfg.complex_storage_dtype
+    return {
+        'features_version': FEATURES_VERSION,
+        'preprocess_mode': preprocess_mode,
+        'working_sample_rate': int(sample_rate),
+        'audio_channels': int(cfg.audio_channels),
+        'resample_quality': cfg.resample_quality,
+        'frame_size': int(cfg.frame_size),
+        'hop_size': int(cfg.hop_size),
+        'NFFT': int(n_fft),
+        'window': 'hann_symmetric',
+        'mel_bins': int(mel_bins),
+        'mel_min_freq': float(mel_min_freq),
+        'mel_max_freq': float(mel_max_freq),
+        'mel_filter_bank': f"librosa-{version('librosa')}",
+        'storage_dtype': storage_dtype,
+        'labels': label_params,
+    }
+
+
+def get_feature_cache_key(feature_params):
+    return hashlib.sha1(json.dumps(feature_params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_feature_cache_dir(root_dir, feature_params):
+    """
+    The directory of the features with the given parameters under root_dir: '<preprocess_mode>-<cache key>'. The
+    parameters are written next to the features in a human readable params.json
+    """
+    cache_dir = os.path.join(root_dir, f"{feature_params['preprocess_mode']}-{get_feature_cache_key(feature_params)}")
+    params_path = os.path.join(cache_dir, PARAMS_FILE_NAME)
+    if not os.path.exists(params_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        atomic_write(params_path, lambda f: json.dump(feature_params, f, indent=4, sort_keys=True), mode='w')
+    return cache_dir
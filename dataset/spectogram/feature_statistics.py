@@ -0,0 +1,51 @@
+import numpy as np
+
+# Mergeable normalization statistics of features: (count, mean, m2) per frequency / mel bin where m2 is the sum of
+# squared distances (|x - mean|^2 for complex features) from the mean. Statistics of disjoint sets of frames are merged
+# with the parallel update of Chan et al., so the statistics of any set of files are computed from the statistics of
+# each file without reading their features again.
+
+
+def calculate_feature_statistics(x):
+    """
+    Args:
+        x: (frames, bins) or (channels, frames, bins) features
+    Returns:
+        (count, mean, m2) over all axes but the last
+    """
+    axis = tuple(range(x.ndim - 1))
+    count = int(np.prod(x.shape[:-1]))
+    mean = np.mean(x, axis=axis, dtype=np.complex128 if np.iscomplexobj(x) else np.float64)
+    m2 = np.sum(np.abs(x - mean) ** 2, axis=axis, dtype=np.float64)
+    return count, mean, m2
+
+
+def merge_feature_statistics(statistics_a, statistics_b):
+    count_a, mean_a, m2_a = statistics_a
+    count_b, mean_b, m2_b = statistics_b
+    count = count_a + count_b
+    if count == 0:
+        return statistics_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + np.abs(delta) ** 2 * (count_a * count_b / count)
+    return count, mean, m2
+
+
+def reduce_feature_statistics(statistics_list):
+    statistics_list = list(statistics_list)
+    if not statistics_list:
+        raise ValueError("Can't reduce the statistics of an empty set of files")
+    total = statistics_list[0]
+    for statistics in statistics_list[1:]:
+        total = merge_feature_statistics(total, statistics)
+    return total
+
+
+def statistics_to_mean_std(statistics):
+    """
+    The mean and std the features are normalized with (the same as np.mean and np.std of the concatenated features)
+    """
+    count, mean, m2 = statistics
+    std = np.sqrt(m2 / count)
+    return mean.astype(np.complex64 if np.iscomplexobj(mean) else np.float32), std.astype(np.float32)
@@ -0,0 +1,267 @@
+import os
+import pickle
+import uuid
+
+import numpy as np
+
+import dataset.spectogram.spectogram_configs as cfg
+from dataset.spectogram.feature_statistics import calculate_feature_statistics, reduce_feature_statistics, \
+    statistics_to_mean_std
+from utils.common import atomic_write
+
+# A feature store is a directory of .npy shards, each holding the features of several consecutive files concatenated
+# along the frames axis (channels, frames, bins), and an index.pkl that maps each file to its shard, frame offset,
+# labels and the signature of its source audio. The normalization statistics of the files (see feature_statistics.py)
+# are written next to each shard, one row per file, and are only read when a mean and std are needed so the index
+# stays small (it is loaded by every reader and dataloader worker). Shards are written once (atomically) and read
+# through read-only memmaps so any number of processes can read crops of a store concurrently and only the touched
+# pages are loaded. A new version of a store may keep referencing the shards of the previous one for files that didn't
+# change (see preprocess_data's incremental mode); once too much of the shards it references belongs to removed or
+# changed files, the kept features are copied to new shards (compaction).
+# Features can be stored in a smaller dtype (e.g float16, complex features as float16 (real, imag) pairs) and only the
+# frequency bins [bin_offset, bin_offset + bins) of the spectogram may be kept; reads return float32 / complex64.
+
+INDEX_FILE_NAME = 'index.pkl'
+STORE_VERSION = 4
+
+
+class FeatureStoreWriter:
+    def __init__(self, store_dir, shard_max_bytes=None, storage_dtype=None, bin_offset=0):
+        """
+        Args:
+            store_dir: directory of the store. An existing store there is replaced when the writer is closed
+            shard_max_bytes: a shard is written once its buffered features exceed this size
+            storage_dtype: dtype of the stored features; float32 / complex64 if None. A real dtype for complex
+                features stores their real and imaginary parts in a trailing axis of size 2
+            bin_offset: frequency bin of the features' first bin, recorded for the readers
+        """
+        self.store_dir = store_dir
+        self.shard_max_bytes = shard_max_bytes or cfg.feature_shard_max_bytes
+        if storage_dtype is not None and np.dtype(storage_dtype) in [np.float32, np.complex64]:
+            storage_dtype = None
+        self.storage_dtype = storage_dtype
+        self.bin_offset = bin_offset
+        self.is_complex = None
+        self.files = []
+        self.buffered_features = []
+        self.buffered_statistics = []
+        self.buffered_bytes = 0
+        self.shard_frames = 0
+        self.shard_name = None
+        os.makedirs(store_dir, exist_ok=True)
+
+    def add(self, name, features, start_times, end_times, statistics=None, source=None, class_ids=None):
+        """
+        Args:
+            features: (channels, frames, bins) array; all the files of a store should share its dtype and shape[::2]
+            statistics: the file's calculate_feature_statistics(features), computed here if None
+            source: signature of the source audio (see get_source_signature)
+            class_ids: class of each event; all events are of class 0 if None
+        """
+        if statistics is None:
+            statistics = calculate_feature_statistics(features)
+        self.is_complex = np.iscomplexobj(features)
+        self._add_stored_features({'name': name, 'start_times': np.asarray(start_times),
+                                   'end_times': np.asarray(end_times),
+                                   'class_ids': _get_class_ids(start_times, class_ids), 'source': source},
+                                  encode_features(features, self.storage_dtype), statistics)
+
+    def add_existing(self, store, i, start_times, end_times, source=None, class_ids=None, copy=False):
+        """
+        Adds file i of the current store in this directory without recomputing its features; only its labels (and
+        source signature if given) are replaced. The features are referenced in their current shard unless copy is
+        set, which copies them to a new shard (see FeatureStore.get_dead_fraction)
+        """
+        assert self.is_compatible(store), "The existing store was written with different storage parameters"
+        self.is_complex = store.is_complex
+        file = dict(store.files[i], start_times=np.asarray(start_times), end_times=np.asarray(end_times),
+                    class_ids=_get_class_ids(start_times, class_ids))
+        if source is not None:
+            file['source'] = source
+        if copy:
+            self._add_stored_features(file, np.array(store.read_stored_features(i)), store.get_statistics(i))
+        else:
+            self.files.append(file)
+
+    def _add_stored_features(self, file, features, statistics):
+        if self.shard_name is None:
+            self.shard_name = f"shard_{uuid.uuid4().hex}.npy"
+        self.files.append(dict(file, shard=self.shard_name, offset=self.shard_frames, frames_num=features.shape[1],
+                               statistics_row=len(self.buffered_statistics)))
+        self.buffered_features.append(features)
+        self.buffered_statistics.append(statistics)
+        self.buffered_bytes += features.nbytes
+        self.shard_frames += features.shape[1]
+        if self.buffered_bytes >= self.shard_max_bytes:
+            self._write_shard()
+
+    def is_compatible(self, store):
+        return os.path.samefile(store.store_dir, self.store_dir) and store.storage_dtype == self.storage_dtype \
+               and store.bin_offset == self.bin_offset
+
+    def close(self):
+        if self.buffered_features:
+            self._write_shard()
+        index = {'version': STORE_VERSION, 'files': self.files, 'bin_offset': self.bin_offset,
+                 'storage_dtype': self.storage_dtype, 'is_complex': self.is_complex}
+        atomic_write(os.path.join(self.store_dir, INDEX_FILE_NAME), lambda f: pickle.dump(index, f))
+
+        # Remove the shards that are no longer referenced (processes that already opened them keep reading them)
+        shards = set(file['shard'] for file in self.files)
+        referenced_files = shards | set(_get_statistics_file_name(shard) for shard in shards)
+        for file_name in os.listdir(self.store_dir):
+            if file_name.startswith('shard_') and file_name not in referenced_files:
+                os.remove(os.path.join(self.store_dir, file_name))
+
+    def _write_shard(self):
+        shard = np.concatenate(self.buffered_features, axis=1)
+        counts, means, m2s = zip(*self.buffered_statistics)
+        statistics = {'count': np.array(counts, dtype=np.int64), 'mean': np.stack(means), 'm2': np.stack(m2s)}
+        atomic_write(os.path.join(self.store_dir, _get_statistics_file_name(self.shard_name)),
+                      lambda f: np.savez(f, **statistics))
+        atomic_write(os.path.join(self.store_dir, self.shard_name), lambda f: np.save(f, shard))
+        self.shard_name = None
+        self.buffered_features = []
+        self.buffered_statistics = []
+        self.buffered_bytes = 0
+        self.shard_frames = 0
+
+
+class FeatureStore:
+    """
+    Read access to a store written by FeatureStoreWriter. Only the index is loaded on creation; features are
+    memmaps of the shards, opened on first use.
+    bin_offset is the frequency bin of the first bin of the features.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE_NAME), 'rb') as f:
+            index = pickle.load(f)
+        if index['version'] != STORE_VERSION:
+            raise ValueError(f"Unsupported feature store version {index['version']}")
+        self.files = index['files']
+        self.names = [file['name'] for file in self.files]
+        self.bin_offset = index['bin_offset']
+        self.storage_dtype = index['storage_dtype']
+        self.is_complex = index['is_complex']
+        self.shard_memmaps = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getstate__(self):
+        # Memmaps are reopened by each process rather than pickled (which copies their content)
+        state = self.__dict__.copy()
+        state['shard_memmaps'] = {}
+        return state
+
+    def get_frames_num(self, i):
+        return self.files[i]['frames_num']
+
+    def get_labels(self, i):
+        """
+        start_times, end_times and class_ids of the events of file i
+        """
+        file = self.files[i]
+        # Stores written before class ids were recorded hold single class labels
+        class_ids = file['class_ids'] if 'class_ids' in file else _get_class_ids(file['start_times'], None)
+        return file['start_times'], file['end_times'], class_ids
+
+    def get_source(self, i):
+        return self.files[i]['source']
+
+    def get_mean_std(self, file_indices=None):
+        """
+        Per bin mean and std of the features of the given files (all files if None), merged from their statistics
+        """
+        file_indices = range(len(self.files)) if file_indices is None else file_indices
+        return statistics_to_mean_std(reduce_feature_statistics(self._iter_statistics(file_indices)))
+
+    def get_statistics(self, i):
+        """
+        (count, mean, m2) statistics of the features of file i
+        """
+        return next(self._iter_statistics([i]))
+
+    def _iter_statistics(self, file_indices):
+        # The files of a shard are consecutive so its statistics are usually loaded once
+        shard, statistics = None, None
+        for i in file_indices:
+            file = self.files[i]
+            if file['shard'] != shard:
+                shard = file['shard']
+                with np.load(os.path.join(self.store_dir, _get_statistics_file_name(shard))) as f:
+                    statistics = (f['count'], f['mean'], f['m2'])
+            row = file['statistics_row']
+            yield int(statistics[0][row]), statistics[1][row], statistics[2][row]
+
+    def get_dead_fraction(self, file_indices=None):
+        """
+        Fraction of the frames of the shards holding the given files (all files if None) that belong to none of them,
+        e.g the features of removed or changed files still stored in shards shared with files that are kept
+        """
+        file_indices = range(len(self.files)) if file_indices is None else file_indices
+        shards = set(self.files[i]['shard'] for i in file_indices)
+        total_frames = sum(self._get_shard(shard).shape[1] for shard in shards)
+        if total_frames == 0:
+            return 0.0
+        return 1 - sum(self.files[i]['frames_num'] for i in file_indices) / total_frames
+
+    def get_features(self, i):
+        """
+        (channels, frames, bins) features of file i: a read-only memmap view if they are stored in their own dtype,
+        otherwise decoded into memory
+        """
+        return self.read_crop(i, 0, self.files[i]['frames_num'], copy=False)
+
+    def read_crop(self, i, start, end, copy=True):
+        """
+        Features of frames [start, end) of file i loaded into memory
+        """
+        stored_features = self.read_stored_features(i, start, end)
+        if self.storage_dtype is None:
+            return np.array(stored_features) if copy else stored_features
+        return decode_features(stored_features, self.is_complex)
+
+    def read_stored_features(self, i, start=0, end=None):
+        """
+        Memmap view of frames [start, end) of file i as stored (see encode_features)
+        """
+        file = self.files[i]
+        end = file['frames_num'] if end is None else min(end, file['frames_num'])
+        return self._get_shard(file['shard'])[:, file['offset'] + start: file['offset'] + end]
+
+    def _get_shard(self, shard):
+        if shard not in self.shard_memmaps:
+            self.shard_memmaps[shard] = np.load(os.path.join(self.store_dir, shard), mmap_mode='r')
+        return self.shard_memmaps[shard]
+
+
+def encode_features(features, storage_dtype):
+    if storage_dtype is None:
+        return features
+    if np.iscomplexobj(features):
+        return np.stack([features.real, features.imag], axis=-1).astype(storage_dtype)
+    return features.astype(storage_dtype)
+
+
+def decode_features(stored_features, is_complex):
+    if is_complex:
+        # (..., bins, 2) float32 pairs are laid out like (..., bins) complex64
+        return np.ascontiguousarray(stored_features, dtype=np.float32).view(np.complex64)[..., 0]
+    return stored_features.astype(np.float32)
+
+
+def _get_class_ids(start_times, class_ids):
+    if class_ids is None:
+        return np.zeros(len(start_times), dtype=np.int64)
+    return np.asarray(class_ids, dtype=np.int64)
+
+
+def _get_statistics_file_name(shard):
+    return f"{os.path.splitext(shard)[0]}_statistics.npz"
+
+
+def feature_store_exists(store_dir):
+    return os.path.exists(os.path.join(store_dir, INDEX_FILE_NAME))
+
@@ -0,0 +1,142 @@
+import argparse
+import os
+import time
+from functools import lru_cache
+
+import numpy as np
+
+import dataset.spectogram.spectogram_configs as cfg
+from utils.common import next_fast_length
+
+FFT_BACKENDS = ['numpy', 'scipy', 'pyfftw']
+
+
+class NumpyFFT:
+    """
+    numpy.fft (pocketfft); twiddle factors are cached internally by numpy
+    """
+    name = 'numpy'
+
+    def rfft(self, frames, n):
+        return np.fft.rfft(frames, n, axis=-1)
+
+
+class ScipyFFT:
+    """
+    scipy.fft (pocketfft) which keeps an internal cache of plans and can split a batch of frames across threads
+    """
+    name = 'scipy'
+
+    def __init__(self, workers=None):
+        import scipy.fft
+        self.scipy_fft = scipy.fft
+        self.workers = workers
+
+    def rfft(self, frames, n):
+        return self.scipy_fft.rfft(frames, n, axis=-1, workers=self.workers)
+
+
+class PyFFTW:
+    """
+    FFTW through pyfftw (optional dependency). Frames are transformed in batches whose size is rounded up to a power of
+    two (at most batch_frames, the rest zero padded) so only a few plans are built per (frame size, dtype, n), whatever
+    the number of frames of each call (e.g the last batch of a file or a streaming block), and reused
+    """
+    name = 'pyfftw'
+
+    def __init__(self, workers=None, planner_effort='FFTW_MEASURE', batch_frames=128):
+        import pyfftw
+        self.pyfftw = pyfftw
+        self.threads = workers if workers is not None and workers > 0 else os.cpu_count()
+        self.planner_effort = planner_effort
+        self.batch_frames = batch_frames
+        self.plans = {}
+
+    def rfft(self, frames, n):
+        flat_frames = frames.reshape(-1, frames.shape[-1])
+        output = np.empty((len(flat_frames), n // 2 + 1), dtype=np.result_type(frames.dtype, np.complex64))
+        for start in range(0, len(flat_frames), self.batch_frames):
+            batch = flat_frames[start: start + self.batch_frames]
+            plan, plan_input = self._get_plan(len(batch), frames.shape[-1], frames.dtype, n)
+            plan_input[:len(batch)] = batch
+            plan_input[len(batch):] = 0
+            # The plan reuses its output buffer so the rows are copied out
+            output[start: start + len(batch)] = plan(plan_input)[:len(batch)]
+        return output.reshape(frames.shape[:-1] + (n // 2 + 1,))
+
+    def _get_plan(self, frames_num, frame_size, dtype, n):
+        batch_size = min(self.batch_frames, 1 << (frames_num - 1).bit_length())
+        key = (batch_size, frame_size, dtype.str, n)
+        if key not in self.plans:
+            plan_input = self.pyfftw.empty_aligned((batch_size, frame_size), dtype=dtype)
+            plan = self.pyfftw.builders.rfft(plan_input, n, axis=-1, threads=self.threads,
+                                             planner_effort=self.planner_effort)
+            self.plans[key] = (plan, plan_input)
+        return self.plans[key]
+
+
+def get_fft_backend(name=None, workers=None):
+    """
+    Returns the FFT backend by name ('numpy', 'scipy', 'pyfftw' or 'auto' for the fastest one on this host).
+    Defaults to cfg.fft_backend and cfg.fft_workers
+    """
+    return _get_fft_backend(name or cfg.fft_backend, cfg.fft_workers if workers is None else workers)
+
+
+@lru_cache(maxsize=None)
+def _get_fft_backend(name, workers):
+    if name == 'auto':
+        name = select_fastest_backend(cfg.NFFT, workers)
+    if name == 'numpy':
+        return NumpyFFT()
+    elif name == 'scipy':
+        return ScipyFFT(workers)
+    elif name == 'pyfftw':
+        return PyFFTW(workers)
+    raise ValueError(f"FFT backend should be one of {FFT_BACKENDS + ['auto']}, '{name}' given")
+
+
+def get_available_backends(workers=None):
+    backends = [NumpyFFT(), ScipyFFT(workers)]
+    try:
+        backends.append(PyFFTW(workers))
+    except ImportError:
+        pass
+    return backends
+
+
+def benchmark_backends(n, workers=None, frames_num=64, frame_size=None, repeats=5):
+    """
+    Returns the best time (seconds) of every available backend over 'repeats' rffts of (frames_num, frame_size)
+    float32 frames padded to n
+    """
+    frames = np.random.randn(frames_num, frame_size or n).astype(np.float32)
+    times = {}
+    for backend in get_available_backends(workers):
+        backend.rfft(frames, n)  # Warm up / plan
+        best = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            backend.rfft(frames, n)
+            best = min(best, time.perf_counter() - start)
+        times[backend.name] = best
+    return times
+
+
+@lru_cache(maxsize=None)
+def select_fastest_backend(n, workers=None):
+    times = benchmark_backends(n, workers)
+    return min(times, key=times.get)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the fastest FFT backend for the spectogram configuration')
+    parser.add_argument('--workers', type=int, default=None, help='Threads used by the scipy and pyfftw backends')
+    parser.add_argument('--frames_num', type=int, default=64)
+    args = parser.parse_args()
+
+    for n in sorted({cfg.NFFT, next_fast_length(cfg.frame_size)}):
+        print(f"rfft of {args.frames_num} frames of {cfg.frame_size} samples padded to {n}:")
+        times = benchmark_backends(n, args.workers, frames_num=args.frames_num, frame_size=cfg.frame_size)
+        for name, best in sorted(times.items(), key=lambda x: x[1]):
+            print(f"\t{name}: {best * 1000:.2f}ms ({best / args.frames_num * 1e6:.1f}us per frame)")
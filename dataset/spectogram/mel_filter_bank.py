@@ -0,0 +1,30 @@
+import numpy as np
+
+
+class CroppedMelFilterBank:
+    """
+    A mel filter bank cropped to its support: the frequency bins [first_bin, last_bin) that affect any mel band.
+    Applying it is a dense matrix product over the support only, and only those bins of a spectogram need to be
+    computed or stored (e.g the compact Complex features).
+    """
+    def __init__(self, dense_filter_bank):
+        """
+        Args:
+            dense_filter_bank: (frequency_bins, mel_bins) matrix as returned by librosa.filters.mel(...).T
+        """
+        self.num_bins, self.mel_bins = dense_filter_bank.shape
+        non_zero_bins = np.nonzero(np.any(dense_filter_bank != 0, axis=1))[0]
+        self.first_bin = int(non_zero_bins[0]) if len(non_zero_bins) else 0
+        self.last_bin = int(non_zero_bins[-1]) + 1 if len(non_zero_bins) else 0
+        self.matrix = np.ascontiguousarray(dense_filter_bank[self.first_bin: self.last_bin])
+
+    def apply(self, power_spectogram, bin_offset=0):
+        """
+        Args:
+            power_spectogram: (..., bins) array whose first bin is frequency bin 'bin_offset'. It should cover the
+                support of the filter bank: [first_bin, last_bin)
+        Returns:
+            mel spectogram: (..., mel_bins)
+        """
+        support = power_spectogram[..., self.first_bin - bin_offset: self.last_bin - bin_offset]
+        return np.matmul(support, self.matrix.astype(power_spectogram.dtype, copy=False))
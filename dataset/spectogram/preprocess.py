@@ -1,108 +1,400 @@
+import hashlib
 import os
 import pickle
 import random
-import librosa
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import soundfile
+from numpy.lib.stride_tricks import sliding_window_view
 from tqdm import tqdm
 
 import dataset.spectogram.spectogram_configs as cfg
 from dataset.dataset_utils import read_multichannel_audio
+from dataset.spectogram.feature_constants import get_analysis_window, get_mel_filter_bank, get_mel_params
+from dataset.spectogram.feature_statistics import calculate_feature_statistics
+from dataset.spectogram.feature_store import FeatureStore, FeatureStoreWriter, feature_store_exists
+from dataset.spectogram.fft_backends import get_fft_backend
 from utils.plot_utils import plot_sample_features
 
-MEL_FILTER_BANK_MATRIX = librosa.filters.mel(
-    sr=cfg.working_sample_rate,
-    n_fft=cfg.NFFT,
-    n_mels=cfg.mel_bins,
-    fmin=cfg.mel_min_freq,
-    fmax=cfg.mel_max_freq).T
 
-
-def multichannel_stft(multichannel_signal):
+def multichannel_stft(multichannel_signal, frames_per_batch=128):
+    """
+    Complex spectogram (channels, frames, NFFT // 2 + 1) of a (samples, channels) signal, framed like
+    librosa.stft(center=True, pad_mode='reflect'): frame t is centered on sample t * hop_size.
+    """
     (samples, channels_num) = multichannel_signal.shape
-    features = []
+    frames_num = 1 + (samples + 2 * (cfg.NFFT // 2) - cfg.NFFT) // cfg.hop_size
+    window_offset = (cfg.NFFT - cfg.frame_size) // 2
+
+    features = np.empty((channels_num, frames_num, cfg.NFFT // 2 + 1), dtype=np.complex64)
     for c in range(channels_num):
-        complex_spectogram = librosa.core.stft(
-                            y=multichannel_signal[:, c],
-                            n_fft=cfg.NFFT,
-                            win_length=cfg.frame_size,
-                            hop_length=cfg.hop_size,
-                            window=np.hanning(cfg.frame_size),
-                            center=True,
-                            dtype=np.complex64,
-                            pad_mode='reflect').T
-        '''(N, n_fft // 2 + 1)'''
-        features.append(complex_spectogram)
-    return np.array(features)
-
-
-def multichannel_complex_to_log_mel(multichannel_complex_spectogram):
-    multichannel_power_spectogram = np.abs(multichannel_complex_spectogram) ** 2
-    multichannel_mel_spectogram = np.dot(multichannel_power_spectogram, MEL_FILTER_BANK_MATRIX)
-    multichannel_logmel_spectogram = librosa.core.power_to_db(multichannel_mel_spectogram,
-                                                              ref=1.0, amin=1e-10, top_db=None).astype(np.float32)
+        padded_signal = np.pad(multichannel_signal[:, c].astype(np.float32), cfg.NFFT // 2, mode='reflect')
+        frames = sliding_window_view(padded_signal[window_offset:], cfg.frame_size)[::cfg.hop_size][:frames_num]
+        for start in range(0, frames_num, frames_per_batch):
+            features[c, start: start + frames_per_batch] = windowed_frames_rfft(frames[start: start + frames_per_batch])
+    return features
+
+
+def windowed_frames_rfft(frames):
+    """
+    Spectrum (..., NFFT // 2 + 1) of (..., frame_size) frames of samples. Like librosa.stft the analysis window is
+    centered inside the NFFT long zero padded frame. The FFTs run on cfg.fft_backend.
+    """
+    window_offset = (cfg.NFFT - cfg.frame_size) // 2
+    padded_frames = np.zeros(frames.shape[:-1] + (cfg.NFFT,), dtype=np.float32)
+    np.multiply(frames, get_analysis_window().astype(np.float32),
+                out=padded_frames[..., window_offset: window_offset + cfg.frame_size])
+    return get_fft_backend().rfft(padded_frames, cfg.NFFT).astype(np.complex64, copy=False)
+
+
+def multichannel_complex_to_log_mel(multichannel_complex_spectogram, mel_params=None, bin_offset=0):
+    """
+    Args:
+        mel_params: (sample_rate, n_fft, mel_bins, fmin, fmax) of the mel filter bank; the configuration's if None
+        bin_offset: frequency bin of the first bin of the spectogram, which should cover the filter bank's support
+    """
+    mel_filter_bank = get_mel_filter_bank(mel_params)
+    # Only the bins inside the filter bank's support contribute to the mel bands
+    first_bin, last_bin = mel_filter_bank.first_bin - bin_offset, mel_filter_bank.last_bin - bin_offset
+    support = multichannel_complex_spectogram[..., first_bin: last_bin]
+    multichannel_power_spectogram = support.real ** 2 + support.imag ** 2
+    multichannel_mel_spectogram = mel_filter_bank.apply(multichannel_power_spectogram, bin_offset=mel_filter_bank.first_bin)
+    multichannel_logmel_spectogram = power_to_db(multichannel_mel_spectogram)
 
     return multichannel_logmel_spectogram
 
 
-def calculate_scalar_of_tensor(x):
-    if x.ndim == 2:
-        axis = 0
-    elif x.ndim == 3:
-        axis = (0, 1)
+def power_to_db(power_spectogram, amin=1e-10):
+    """
+    librosa.power_to_db with ref=1.0 and top_db=None
+    """
+    return (10 * np.log10(np.maximum(amin, power_spectogram))).astype(np.float32)
 
-    mean = np.mean(x, axis=axis)
-    std = np.std(x, axis=axis)
 
-    return mean, std
+def extract_features(multichannel_waveform, preprocess_mode='logMel'):
+    """
+    Complex spectogram (channels, frames, NFFT // 2 + 1) of a (samples, channels) waveform or its log mel
+    spectogram (channels, frames, mel_bins) if preprocess_mode is 'logMel', computed with cfg.feature_frontend
+    """
+    if cfg.feature_frontend == 'torch':
+        from dataset.spectogram.torch_frontend import batch_stft_and_log_mel
+        return batch_stft_and_log_mel([multichannel_waveform], preprocess_mode)[0]
 
+    feature = multichannel_stft(multichannel_waveform)
+    if preprocess_mode == 'logMel':
+        feature = multichannel_complex_to_log_mel(feature)
+    return feature
 
-def preprocess_data(audio_path_and_labels, output_dir, output_mean_std_file, preprocess_mode='logMel'):
-    print("Preprocessing collected data")
-    os.makedirs(output_dir, exist_ok=True)
 
-    all_features = []
+def complex_to_log_mel(multichannel_complex_spectogram, mel_params=None, bin_offset=0):
+    """
+    multichannel_complex_to_log_mel computed with cfg.feature_frontend. The torch frontend holds the configuration's
+    filter bank so other mel parameters are always projected with the numpy implementation.
+    """
+    if cfg.feature_frontend == 'torch' and (mel_params is None or tuple(mel_params) == get_mel_params()):
+        import torch
+        from dataset.spectogram.torch_frontend import get_frontend
+        with torch.no_grad():
+            return get_frontend().complex_to_log_mel(torch.from_numpy(multichannel_complex_spectogram),
+                                                     bin_offset=bin_offset).numpy()
 
-    for (audio_path, start_times, end_times, audio_name) in tqdm(audio_path_and_labels):
-        multichannel_waveform = read_multichannel_audio(audio_path=audio_path, target_fs=cfg.working_sample_rate)
-        feature = multichannel_stft(multichannel_waveform)
-        if preprocess_mode == 'logMel':
-            feature = multichannel_complex_to_log_mel(feature)
-        all_features.append(feature)
+    return multichannel_complex_to_log_mel(multichannel_complex_spectogram, mel_params, bin_offset)
 
-        output_path = os.path.join(output_dir, audio_name + f"_{preprocess_mode}_features_and_labels.pkl")
-        with open(output_path, 'wb') as f:
-            pickle.dump({'features': feature, 'start_times': start_times, 'end_times': end_times},
-                        f)
 
-    all_features = np.concatenate(all_features, axis=1)
-    mean, std = calculate_scalar_of_tensor(all_features)
-    with open(output_mean_std_file, 'wb') as f:
-        pickle.dump({'mean': mean, 'std': std}, f)
+def get_feature_config(preprocess_mode, output_dir, output_mean_std_file, mel_bins=None, mel_min_freq=None,
+                       mel_max_freq=None, storage_dtype=None):
+    """
+    Describes one output of preprocess_data_multi_config: the features are written to a feature store in output_dir
+    (see feature_store.py). All configurations share the STFT parameters (frame_size, hop_size, NFFT) of the
+    spectogram configuration; mel parameters that are None are taken from it too.
+    Complex features are stored compactly: only the bins of the support of the configuration's mel filter bank are
+    kept, in storage_dtype (cfg.complex_storage_dtype if None).
+    """
+    assert preprocess_mode in ['logMel', 'Complex'], "Spectogram type should be either logmel or complex"
+    mel_params = (cfg.working_sample_rate, cfg.NFFT,
+                  cfg.mel_bins if mel_bins is None else mel_bins,
+                  cfg.mel_min_freq if mel_min_freq is None else mel_min_freq,
+                  cfg.mel_max_freq if mel_max_freq is None else mel_max_freq)
+    if storage_dtype is None and preprocess_mode == 'Complex':
+        storage_dtype = cfg.complex_storage_dtype
+    return {'preprocess_mode': preprocess_mode, 'mel_params': mel_params, 'storage_dtype': storage_dtype,
+            'output_dir': output_dir, 'output_mean_std_file': output_mean_std_file}
+
+
+def preprocess_data(audio_path_and_labels, output_dir, output_mean_std_file, preprocess_mode='logMel', workers=None,
+                    incremental=False):
+    preprocess_data_multi_config(audio_path_and_labels,
+                                 [get_feature_config(preprocess_mode, output_dir, output_mean_std_file)],
+                                 workers=workers, incremental=incremental)
+
+
+def preprocess_data_multi_config(audio_path_and_labels, feature_configs, workers=None, retries=None, incremental=False):
+    """
+    Preprocess the data into several feature configurations (see get_feature_config) at once: every file is decoded
+    and transformed by the STFT once and the complex spectogram is then projected on the mel filter bank of each
+    configuration.
+    Files are processed by a pool of 'workers' processes (cfg.preprocess_workers if None) and written in the order of
+    audio_path_and_labels. A file that fails 'retries' + 1 times is reported and left out.
+    If incremental and the feature stores of all the configurations exist, they are updated: files whose source audio
+    didn't change since they were preprocessed (see get_unchanged_source) keep their features, only new or changed
+    files are processed and files that are no longer in audio_path_and_labels are removed. Nothing is written if no
+    file, label or source signature changed. The kept features are compacted into new shards if more than
+    cfg.feature_store_max_dead_fraction of the shards holding them is unused.
+    """
+    workers = cfg.preprocess_workers if workers is None else workers
+    retries = cfg.preprocess_retries if retries is None else retries
+    content_hash = cfg.preprocess_change_detection == 'hash'
+    writers = []
+    for feature_config in feature_configs:
+        # Complex features are cropped to the support of their mel filter bank
+        bin_offset = 0
+        if feature_config['preprocess_mode'] == 'Complex':
+            bin_offset = get_mel_filter_bank(feature_config['mel_params']).first_bin
+        writers.append(FeatureStoreWriter(feature_config['output_dir'], storage_dtype=feature_config['storage_dtype'],
+                                          bin_offset=bin_offset))
+
+    existing_stores = [_open_existing_store(writer) if incremental else None for writer in writers]
+    # Files can only be reused if every store already holds them: without all the stores this is a full preprocessing
+    incremental = incremental and all(store is not None for store in existing_stores)
+    reusable_files = [_get_reusable_files(audio_path, audio_name, existing_stores, content_hash)
+                      for (audio_path, _, _, audio_name, _) in audio_path_and_labels]
+    tasks = [(audio_path, feature_configs, retries, content_hash)
+             for (audio_path, _, _, _, _), reusable in zip(audio_path_and_labels, reusable_files) if reusable is None]
+    compact = [False] * len(writers)
+    if incremental:
+        names = set(audio_name for (_, _, _, audio_name, _) in audio_path_and_labels)
+        removed_num = len(set(existing_stores[0].names) - names) if existing_stores[0] is not None else 0
+        print(f"Incremental preprocessing: {len(audio_path_and_labels) - len(tasks)} unchanged files, "
+              f"{len(tasks)} new or changed files and {removed_num} removed files")
+        for j, store in enumerate(existing_stores):
+            kept_files = [reusable[1][j] for reusable in reusable_files if reusable is not None]
+            if kept_files and store.get_dead_fraction(kept_files) > cfg.feature_store_max_dead_fraction:
+                print(f"Compacting the feature store in {store.store_dir}")
+                compact[j] = True
+        if not tasks and not removed_num and not any(compact) and \
+                _is_up_to_date(audio_path_and_labels, reusable_files, existing_stores, feature_configs):
+            print("Preprocessed data is up to date")
+            return
+    print(f"Preprocessing {len(tasks)} files into {len(feature_configs)} feature configurations with {workers} workers")
+
+    processed = []
+    failures = []
+    results = _map_in_order(_extract_file_features, tasks, workers)
+    for (audio_path, start_times, end_times, audio_name, class_ids), reusable in \
+            tqdm(zip(audio_path_and_labels, reusable_files), total=len(audio_path_and_labels)):
+        if reusable is not None:
+            (source, file_indices) = reusable
+            for writer, store, i, copy in zip(writers, existing_stores, file_indices, compact):
+                writer.add_existing(store, i, start_times, end_times, source, class_ids, copy)
+            continue
+
+        features, source, error = next(results)
+        if error is not None:
+            failures.append((audio_path, error))
+            continue
+        processed.append((audio_path, start_times, end_times, audio_name, class_ids))
+        for writer, (feature, statistics) in zip(writers, features):
+            writer.add(audio_name, feature, start_times, end_times, statistics, source, class_ids)
+
+    if failures:
+        print(f"Failed to preprocess {len(failures)} files:")
+        for audio_path, error in failures:
+            print(f"\t{audio_path}: {error}")
+    if not writers[0].files:
+        raise Exception("Preprocessing failed for all files")
+
+    for feature_config, writer in zip(feature_configs, writers):
+        writer.close()
+        # The statistics of each file are stored with its features; the mean and std of the data set are merged
+        # from them
+        mean, std = FeatureStore(feature_config['output_dir']).get_mean_std()
+        with open(feature_config['output_mean_std_file'], 'wb') as f:
+            pickle.dump({'mean': mean, 'std': std}, f)
 
     # Visualize single data sample
-    (audio_path, start_times, end_times, audio_name) = random.choice(audio_path_and_labels)
-    analyze_data_sample(audio_path, start_times, end_times, audio_name,
-                        os.path.join(os.path.dirname(output_mean_std_file), "data_sample.png"))
+    if processed:
+        (audio_path, start_times, end_times, audio_name, class_ids) = random.choice(processed)
+        analyze_data_sample(audio_path, start_times, end_times, audio_name, class_ids,
+                            os.path.join(os.path.dirname(feature_configs[0]['output_mean_std_file']), "data_sample.png"))
+
+
+def get_source_signature(audio_path, content_hash=False):
+    """
+    Identifies the version of an audio file by its path, size and modification time and optionally a hash of its
+    content
+    """
+    stat = os.stat(audio_path)
+    source = {'path': os.path.abspath(audio_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if content_hash:
+        source['sha1'] = _get_file_sha1(audio_path)
+    return source
+
+
+def get_unchanged_source(audio_path, source, content_hash=False):
+    """
+    Returns the current signature of audio_path if it is the same audio as the one 'source' was taken from, None
+    otherwise. A file with the same size but a different modification time is the same audio if content_hash is set
+    and its hash is unchanged
+    """
+    if source is None or not os.path.exists(audio_path):
+        return None
+    current_source = get_source_signature(audio_path)
+    if current_source['path'] != source['path'] or current_source['size'] != source['size']:
+        return None
+    if current_source['mtime_ns'] == source['mtime_ns']:
+        return source
+    if content_hash and 'sha1' in source and _get_file_sha1(audio_path) == source['sha1']:
+        return dict(current_source, sha1=source['sha1'])
+    return None
+
+
+def _get_file_sha1(path, block_size=2**20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _open_existing_store(writer):
+    """
+    The current store in the writer's directory if the writer can reuse its features, None otherwise
+    """
+    if not feature_store_exists(writer.store_dir):
+        return None
+    try:
+        store = FeatureStore(writer.store_dir)
+    except ValueError as e:
+        print(f"Rewriting the feature store in {writer.store_dir}: {e}")
+        return None
+    if not writer.is_compatible(store):
+        print(f"Rewriting the feature store in {writer.store_dir}: its storage parameters changed")
+        return None
+    store.name_indices = {name: i for i, name in enumerate(store.names)}
+    return store
+
+
+def _is_up_to_date(audio_path_and_labels, reusable_files, existing_stores, feature_configs):
+    """
+    Whether the existing stores already hold all the files, in order, with the same labels and source signatures
+    """
+    if any(not os.path.exists(feature_config['output_mean_std_file']) for feature_config in feature_configs):
+        return False
+    for store in existing_stores:
+        if store.names != [audio_name for (_, _, _, audio_name, _) in audio_path_and_labels]:
+            return False
+    for (_, start_times, end_times, _, class_ids), (source, file_indices) in zip(audio_path_and_labels,
+                                                                                reusable_files):
+        for store, i in zip(existing_stores, file_indices):
+            labels = (start_times, end_times, np.zeros(len(start_times)) if class_ids is None else class_ids)
+            if store.get_source(i) != source or \
+                    any(not np.array_equal(a, np.asarray(b)) for a, b in zip(store.get_labels(i), labels)):
+                return False
+    return True
+
+
+def _get_reusable_files(audio_path, audio_name, existing_stores, content_hash):
+    """
+    Returns the current source signature of the file and its index in each of the existing stores if all of them
+    hold its features and its audio didn't change, None otherwise
+    """
+    file_indices = []
+    for store in existing_stores:
+        if store is None or audio_name not in store.name_indices:
+            return None
+        file_indices.append(store.name_indices[audio_name])
+    sources = [store.get_source(i) for store, i in zip(existing_stores, file_indices)]
+    if any(source != sources[0] for source in sources):
+        return None
+    source = get_unchanged_source(audio_path, sources[0], content_hash)
+    if source is None:
+        return None
+    return source, file_indices
+
+
+def _extract_file_features(audio_path, feature_configs, retries, content_hash=False):
+    """
+    Runs in the preprocessing workers.
+    Returns:
+        [(feature, statistics) for each feature configuration], the signature of the source audio and None or
+        None, None and the error of the last attempt
+    """
+    error = None
+    for _ in range(retries + 1):
+        try:
+            source = get_source_signature(audio_path, content_hash)
+            multichannel_waveform = read_multichannel_audio(audio_path=audio_path, target_fs=cfg.working_sample_rate)
+            complex_spectogram = extract_features(multichannel_waveform, 'Complex')
+
+            features = []
+            for feature_config in feature_configs:
+                if feature_config['preprocess_mode'] == 'logMel':
+                    feature = complex_to_log_mel(complex_spectogram, feature_config['mel_params'])
+                else:
+                    mel_filter_bank = get_mel_filter_bank(feature_config['mel_params'])
+                    feature = complex_spectogram[..., mel_filter_bank.first_bin: mel_filter_bank.last_bin]
+                features.append((feature, calculate_feature_statistics(feature)))
+            return features, source, None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    return None, None, error
+
+
+def _init_preprocess_worker():
+    """
+    Each worker processes a single file at a time with a single thread so the workers don't oversubscribe the cores.
+    The BLAS / OpenMP libraries are already loaded when the workers are forked, so setting their environment variables
+    here has no effect; their thread pools are limited at runtime instead
+    """
+    global _worker_thread_limits
+    from threadpoolctl import threadpool_limits
+    _worker_thread_limits = threadpool_limits(1)
+    cfg.fft_workers = 1
+    if cfg.feature_frontend == 'torch':
+        import torch
+        torch.set_num_threads(1)
+
+
+_worker_thread_limits = None
+
+
+def _map_in_order(function, tasks, workers):
+    """
+    Yields function(*task) for each task. With more than one worker the tasks are run by a process pool; at most
+    'workers' tasks are submitted and not yet yielded, so at most one result per worker is held in memory
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_preprocess_worker) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(function, *task))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
-def analyze_data_sample(audio_path, start_times, end_times, audio_name, plot_path):
+def analyze_data_sample(audio_path, start_times, end_times, audio_name, class_ids, plot_path):
     """
     A debug function that plots a single sample and analyzes how the spectogram configuration affect the feature final size
     """
     from dataset.spectogram.spectograms_dataset import create_event_matrix
-    org_multichannel_audio, org_sample_rate = soundfile.read(audio_path)
+    org_audio_info = soundfile.info(audio_path)
 
     multichannel_audio = read_multichannel_audio(audio_path=audio_path, target_fs=cfg.working_sample_rate)
-    feature = multichannel_stft(multichannel_audio)
-    feature = multichannel_complex_to_log_mel(feature)  # (channels, frames, mel_bins)
-    event_matrix = create_event_matrix(feature.shape[1], start_times, end_times)
+    feature = extract_features(multichannel_audio, 'logMel')  # (channels, frames, mel_bins)
+    event_matrix = create_event_matrix(feature.shape[1], start_times, end_times, class_ids)
     plot_sample_features(feature, mode='spectogram', target=event_matrix, plot_path=plot_path, file_name=audio_name)
 
     signal_time = multichannel_audio.shape[0]/cfg.working_sample_rate
     FPS = cfg.working_sample_rate / cfg.hop_size
     print(f"Data sample analysis: {audio_name}")
-    print(f"\tOriginal audio: {org_multichannel_audio.shape} sample_rate={org_sample_rate}")
+    print(f"\tOriginal audio: {(org_audio_info.frames, org_audio_info.channels)} sample_rate={org_audio_info.samplerate}")
     print(f"\tsingle channel audio: {multichannel_audio.shape}, sample_rate={cfg.working_sample_rate}")
     print(f"\tSignal time is (num_samples/sample_rate)={signal_time:.1f}s")
     print(f"\tSIFT FPS is (sample_rate/hop_size)={FPS}")
@@ -1,13 +1,29 @@
-from utils.common import human_format
+from utils.common import human_format, next_fast_length
 import numpy as np
 from dataset.common_config import *
 
-NFFT = 2**int(np.ceil(np.log2(frame_size)))  # The size of the padded frames on which fft will actualy work. Set this to a power of two for faster preprocessing
+fft_length_policy = 'pow2'                   # 'pow2' or 'fast': pad frames to the next 5-smooth size instead (less padding)
+NFFT = 2**int(np.ceil(np.log2(frame_size))) if fft_length_policy == 'pow2' else next_fast_length(frame_size)  # The size of the padded frames on which fft will actualy work. Set this to a power of two for faster preprocessing
+fft_backend = 'scipy'                        # 'numpy', 'scipy', 'pyfftw' or 'auto' (fastest on this host); see fft_backends.py
+fft_workers = -1                             # Threads used by the scipy / pyfftw backends (-1 for all cores)
 mel_bins = 64                                # How much frames to stretch over the
 mel_min_freq = 20                            # Hz first mel bin (minimal possible value 0)
 mel_max_freq = working_sample_rate // 2      # Hz last mel bin (maximal possible value sampling_rate / 2)
 
 train_crop_size = frames_per_second * 10  # 10-second log mel spectrogram as input
+# 'numpy' (fft_backend) or 'torch' (batched torch.stft, see torch_frontend.py; only checked against numpy above -60dB by
+# torch_frontend.check_parity)
+feature_frontend = 'numpy'
+feature_shard_max_bytes = 2**28           # Size of the shards of preprocessed features (see feature_store.py)
+complex_storage_dtype = 'complex64'       # or 'float16': store the real and imaginary parts of Complex features as float16
+preprocess_workers = min(4, os.cpu_count())  # Preprocessing processes, each holds one file in memory (1: main process)
+preprocess_retries = 1                    # Attempts to preprocess a failing file again before leaving it out
+incremental_preprocess = False            # Update existing preprocessed data with new, changed and removed audio files
+feature_store_max_dead_fraction = 0.25    # Compact a store updated incrementally when more of its shards is unused
+preprocess_change_detection = 'mtime'     # 'mtime' (size and modification time) or 'hash': also compare content hashes
+memmap_train_data = False                 # Share the concatenated train data between DataLoader workers through memmaps
+train_data_memmap_dir = None              # Where the shared train data is written (e.g /dev/shm); the temp dir if None
+transform_on_device = False               # Normalize (and convert Complex to logMel) whole batches on the training device
 
 
 cfg_descriptor = f"Spectogram_SaR-{human_format(working_sample_rate)}_FrS-{human_format(frame_size)}" \
@@ -1,31 +1,42 @@
-import librosa
+import atexit
 import numpy as np
 import os
 import pickle
+import shutil
+import tempfile
 
 import torch
 from torch.utils.data import Dataset
 
-import dataset.spectogram.spectogram_configs
 import dataset.spectogram.spectogram_configs as cfg
-from dataset.dataset_utils import get_film_clap_paths_and_labels, get_tau_sed_paths_and_labels
+from dataset.dataset_utils import get_film_clap_paths_and_labels, get_tau_sed_paths_and_labels, rasterize_events, \
+    EventIntervals
 from dataset.download_tau_sed_2019 import ensure_tau_data
-from dataset.spectogram.preprocess import preprocess_data, multichannel_complex_to_log_mel
+from dataset.spectogram.feature_params import get_feature_params, get_feature_cache_dir
+from dataset.spectogram.feature_store import FeatureStore, feature_store_exists
+from dataset.spectogram.preprocess import get_feature_config, preprocess_data_multi_config, complex_to_log_mel
+from dataset.spectogram.torch_frontend import BatchTransform
 from random import shuffle
 
 
 class SpectogramDataset(Dataset):
     def __init__(self, features_and_labels_dir, mean_std_file, val_descriptor,
-                 balance_classes=False, augment_data=False, preprocessed_mode='Complex'):
+                 balance_classes=False, augment_data=False, preprocessed_mode='Complex', memmap_train_data=None,
+                 transform_on_device=None):
         """
         This dataset loads crops of the entire concatenated features of the data
         Args:
             features_and_labels_dir:
             mean_std_file: mean and std of the saved features # TODO: currently these are different for Complex histograms
+                If None, they are merged from the statistics of the train files stored in the feature store
             val_descriptor: How to split the data; float for percentage and string for specifing substring in desired files
             balance_classes: Limit the number of crops with no event to match the number of crops with events
             augment_data: 1. Add noise. 2. Mix STFT spectograms of multiple samples before converting to LogMel
             preprocessed_mode: defines whether if the preprocess phase included converting to LogMel or only STFT
+            memmap_train_data: Write the concatenated train features to a file in cfg.train_data_memmap_dir that all
+                DataLoader workers map read-only (cfg.memmap_train_data if None)
+            transform_on_device: Return untransformed features and leave their transform to self.batch_transform, applied
+                by the trainer on whole batches (cfg.transform_on_device if None)
         """
         assert preprocessed_mode in ['logMel', 'Complex'], "Spectogram type should be either logmel or complex"
         assert not (preprocessed_mode == 'logMel' and augment_data), "Can't perform augmentation in logMel spectograms"
@@ -33,27 +44,81 @@ class SpectogramDataset(Dataset):
         self.augment_data = augment_data
         self.train_crop_size = cfg.train_crop_size
 
+        # Features are read from the store on demand, only the labels are loaded here
+        self.feature_store = FeatureStore(features_and_labels_dir)
+        file_indices = {name: i for i, name in enumerate(self.feature_store.names)}
+        train_names, val_names = split_train_val(list(self.feature_store.names), val_descriptor)
+        self.train_files = [file_indices[name] for name in train_names]
+        self.val_files = [file_indices[name] for name in val_names]
+
         # Load data mean and std
-        d = pickle.load(open(mean_std_file, 'rb'))
-        self.mean = d['mean']
-        self.std = d['std']
+        if mean_std_file is None:
+            self.mean, self.std = self.feature_store.get_mean_std(self.train_files)
+        else:
+            d = pickle.load(open(mean_std_file, 'rb'))
+            self.mean = d['mean']
+            self.std = d['std']
+
+        # Labels are kept as event intervals and rasterized per crop
+        self.train_event_intervals, self.train_start_indices, self.train_file_offsets, self.train_frames_num = \
+            _read_train_labels(self.feature_store, self.train_files, cfg.train_crop_size, balance_classes)
+
+        self.transform_on_device = cfg.transform_on_device if transform_on_device is None else transform_on_device
+        self.batch_transform = None
+        if self.transform_on_device:
+            self.batch_transform = BatchTransform(self.mean, self.std, preprocessed_mode, self.feature_store.bin_offset)
+
+        self.train_features = None
+        self.train_data_dir = None
+        if cfg.memmap_train_data if memmap_train_data is None else memmap_train_data:
+            self._memmap_train_data()
+
+        val_frames_num = sum(self.feature_store.get_frames_num(i) for i in self.val_files)
+        print(f"Data generator initiated with {len(self.train_files)} train samples "
+              f"totaling {self.train_frames_num / cfg.frames_per_second:.1f} seconds "
+              f"and {len(self.val_files)} val samples "
+              f"totaling {val_frames_num / cfg.frames_per_second:.1f} seconds")
 
-        all_paths = [os.path.join(features_and_labels_dir, x) for x in os.listdir(features_and_labels_dir)]
-        train_feature_paths, self.val_feature_paths = split_train_val(all_paths, val_descriptor)
+    def __len__(self):
+        return len(self.train_start_indices)
 
-        self.train_features, self.train_event_matrix, self.train_start_indices = _read_train_data_to_memory(train_feature_paths,
-                                                                                                            cfg.train_crop_size,
-                                                                                                            balance_classes)
+    def __getstate__(self):
+        # DataLoader workers reopen the memmaps of the train data instead of receiving a copy of it
+        state = self.__dict__.copy()
+        # The batch transform may already be on the training device and isn't used by the workers
+        state['batch_transform'] = None
+        if self.train_data_dir is not None:
+            state['train_features'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.train_data_dir is not None:
+            self._open_train_data()
+
+    def _memmap_train_data(self):
+        """
+        Writes the concatenated train features once to a .npy file and maps it read-only so all the processes reading
+        the data set share the same pages. The file is deleted when the process exits.
+        The features are laid out frames-major (frames, channels, bins) so each crop is one contiguous block.
+        """
+        self.train_data_dir = tempfile.mkdtemp(prefix='spectogram_train_data_', dir=cfg.train_data_memmap_dir)
+        atexit.register(shutil.rmtree, self.train_data_dir, True)
 
-        self.val_features_list, self.val_event_matrix_list = _read_validation_data_to_memory(self.val_feature_paths)
+        first_crop = self.feature_store.read_crop(self.train_files[0], 0, 1)
+        shape = (self.train_frames_num, first_crop.shape[0]) + first_crop.shape[2:]
+        train_features = np.lib.format.open_memmap(os.path.join(self.train_data_dir, 'train_features.npy'), mode='w+',
+                                                   dtype=first_crop.dtype, shape=shape)
+        for file_index, offset in zip(self.train_files, self.train_file_offsets):
+            train_features[offset: offset + self.feature_store.get_frames_num(file_index)] = \
+                self.feature_store.get_features(file_index).swapaxes(0, 1)
+        train_features.flush()
+        del train_features
 
-        print(f"Data generator initiated with {len(train_feature_paths)} train samples "
-              f"totaling {len(self.train_event_matrix) / cfg.frames_per_second:.1f} seconds "
-              f"and {len(self.val_feature_paths)} val samples "
-              f"totaling {len(np.concatenate(self.val_event_matrix_list, axis=0)) / cfg.frames_per_second:.1f} seconds")
+        self._open_train_data()
 
-    def __len__(self):
-        return len(self.train_start_indices)
+    def _open_train_data(self):
+        self.train_features = np.load(os.path.join(self.train_data_dir, 'train_features.npy'), mmap_mode='r')
 
     def __getitem__(self, idx):
         '''
@@ -63,10 +128,7 @@ class SpectogramDataset(Dataset):
           batch_data_dict: dict containing feature, event, elevation and azimuth
         '''
 
-        data_indexes = np.arange(self.train_crop_size) + self.train_start_indices[idx]
-
-        features = self.train_features[:, data_indexes]
-        event_matrix = self.train_event_matrix[data_indexes]
+        features, event_matrix = self.get_train_crop(self.train_start_indices[idx])
 
         if self.augment_data:
             feature, event_matrix = self.augment_mix_samples(features, event_matrix)
@@ -77,20 +139,74 @@ class SpectogramDataset(Dataset):
 
         return torch.from_numpy(features), torch.from_numpy(event_matrix)
 
-    def get_validation_sampler(self, max_validate_num=None):
-        feature_names = self.val_feature_paths
-        features_list = self.val_features_list
-        event_matrix_list = self.val_event_matrix_list
+    def __getitems__(self, indices):
+        """
+        Batch version of __getitem__ used by the DataLoader: the crops of the whole batch are gathered at once and
+        transformed together. Should be used with collate_fn as the returned batch is already collated
+        """
+        batch_features, batch_event_matrix = self.get_train_crops(self.train_start_indices[indices])
+
+        if self.augment_data:
+            for i in range(len(batch_features)):
+                batch_features[i], batch_event_matrix[i] = self.augment_mix_samples(batch_features[i],
+                                                                                    batch_event_matrix[i])
+                batch_features[i], batch_event_matrix[i] = self.augment_add_noise(batch_features[i],
+                                                                                  batch_event_matrix[i])
+
+        batch_features = self.transform(batch_features)
 
-        validate_num = len(feature_names)
+        return torch.from_numpy(batch_features), torch.from_numpy(batch_event_matrix)
 
-        for n in range(validate_num):
+    @staticmethod
+    def collate_fn(batch):
+        return batch
+
+    def get_train_crops(self, start_indices, crop_size=None):
+        """
+        Reads the features (batch, channels, crop_size, bins) and event matrices (batch, crop_size, classes_num) of the
+        crops starting at 'start_indices'. The features are read into a preallocated array: with memmapped train data
+        each crop is one contiguous block of the frames-major features, copied straight into the batch (only its pages
+        are read), otherwise it is read from the feature store. The event matrices of all crops are rasterized at once
+        from the event intervals.
+        """
+        crop_size = crop_size or self.train_crop_size
+        first_crop = self.get_train_features(start_indices[0], 1)
+        batch_features = np.empty((len(start_indices), first_crop.shape[0], crop_size) + first_crop.shape[2:],
+                                  dtype=first_crop.dtype)
+        if self.train_features is not None:
+            for i, start_index in enumerate(start_indices):
+                batch_features[i] = self.train_features[start_index: start_index + crop_size].swapaxes(0, 1)
+        else:
+            for i, start_index in enumerate(start_indices):
+                batch_features[i] = self.get_train_features(start_index, crop_size)
+        batch_event_matrix = self.train_event_intervals.rasterize_windows(start_indices, crop_size, cfg.classes_num)
+        return batch_features, batch_event_matrix
+
+    def get_train_crop(self, start_index, crop_size=None):
+        """
+        Reads the features (channels, crop_size, bins) and event matrix (crop_size, classes_num) of the crop starting at
+        'start_index' of the concatenated train files
+        """
+        crop_size = crop_size or self.train_crop_size
+        event_matrix = self.train_event_intervals.rasterize_windows([start_index], crop_size, cfg.classes_num)[0]
+        return self.get_train_features(start_index, crop_size), event_matrix
+
+    def get_train_features(self, start_index, crop_size):
+        if self.train_features is not None:
+            return np.ascontiguousarray(self.train_features[start_index: start_index + crop_size].swapaxes(0, 1))
+
+        file_index = np.searchsorted(self.train_file_offsets, start_index, side='right') - 1
+        start = start_index - self.train_file_offsets[file_index]
+        return self.feature_store.read_crop(self.train_files[file_index], start, start + crop_size)
+
+    def get_validation_sampler(self, max_validate_num=None):
+        for n, file_index in enumerate(self.val_files):
             if n == max_validate_num:
                 break
 
-            name = os.path.basename(os.path.splitext(feature_names[n])[0])
-            feature = features_list[n]
-            event_matrix = event_matrix_list[n]
+            name = self.feature_store.names[file_index]
+            feature = np.array(self.feature_store.get_features(file_index))
+            event_matrix = create_event_matrix(feature.shape[1], *self.feature_store.get_labels(file_index))
 
             feature = self.transform(feature)
 
@@ -102,12 +218,15 @@ class SpectogramDataset(Dataset):
             yield torch.from_numpy(features), torch.from_numpy(event_matrix), name
 
     def transform(self, x):
+        if self.transform_on_device:
+            return x
+
         x = (x - self.mean) / self.std
 
         if self.preprocessed_mode == 'logMel':
             return x
         else:  # If the preprocessed spectograms are saved as raw complex spectograms transform them into logMel
-            return multichannel_complex_to_log_mel(x)
+            return complex_to_log_mel(x, bin_offset=self.feature_store.bin_offset)
 
     def augment_add_noise(self, batch_feature, batch_event_matrix):
         # TODO these number are fit to noise added to waveform and not spectogram
@@ -124,9 +243,7 @@ class SpectogramDataset(Dataset):
         number_of_augmentations = np.random.choice([0, 1, 2, 3], 1, p=[0.6, 0.25, 0.1, 0.05])[0]
         for i in range(number_of_augmentations):
             random_pointer = np.random.randint(len(self.train_start_indices) + 1)
-            new_data_indexes = np.arange(self.train_crop_size) + self.train_start_indices[random_pointer]
-            new_feature = self.train_features[:, new_data_indexes]
-            new_event_matrix = self.train_event_matrix[new_data_indexes]
+            new_feature, new_event_matrix = self.get_train_crop(self.train_start_indices[random_pointer])
 
             feature += new_feature
             event_matrix = np.maximum(event_matrix, new_event_matrix)
@@ -135,44 +252,43 @@ class SpectogramDataset(Dataset):
         return feature, event_matrix
 
 
-def _read_train_data_to_memory(train_feature_paths, crop_size, balance_classes=False):
+def _read_train_labels(feature_store, train_files, crop_size, balance_classes=False):
     """
-    Creates a list with all spectograms conatenated to each other so that one can sample random crops over them by choosing
-    from a set of start indices.
+    Collects the events of all train files conatenated to each other, as intervals of frames of the concatenation, so
+    that one can sample random crops over them by choosing from a set of start indices. The features of a crop are read
+    from the feature store of the file at the crop's offset and its labels are rasterized from the event intervals.
+    Returns:
+        train_event_intervals, train_start_indices, the offset of each train file in the concatenation and the number
+        of frames of the concatenation
     """
-    # Load training feature and targets
     frame_index = 0
 
-    train_features_list = []
-    train_event_matrix_list = []
+    train_file_offsets = []
+    train_event_frames = []
     train_index_with_event = []
     train_index_empty = []
 
-    for feature_path in train_feature_paths:
-        data = pickle.load(open(feature_path, 'rb'))
-        feature = data['features']
-        event_matrix = create_event_matrix(feature.shape[1], data['start_times'], data['end_times'])
-
-        frames_num = feature.shape[1]
+    for file_index in train_files:
+        frames_num = feature_store.get_frames_num(file_index)
         '''Number of frames of the (log mel / complex) spectrogram of an audio 
         recording. May be different from file to file'''
+        start_frames, end_frames, class_ids = get_event_frames(frames_num, *feature_store.get_labels(file_index))
 
         possible_start_indices = np.arange(frame_index, frame_index + frames_num - crop_size)
+        train_file_offsets.append(frame_index)
+        train_event_frames.append((start_frames + frame_index, end_frames + frame_index, class_ids))
         frame_index += frames_num
 
-        # Append data
-        train_features_list.append(feature)
-        train_event_matrix_list.append(event_matrix)
-
-        # Slpit data to chunks which contain an event and such that are not
-        indices_with_event = np.zeros(possible_start_indices.shape, dtype=bool)
-        for i in np.where(event_matrix > 0)[0]:
-            indices_with_event[i - crop_size: i] = True
-        train_index_with_event += possible_start_indices[np.where(indices_with_event)[0]].tolist()
-        train_index_empty += possible_start_indices[np.where(indices_with_event == False)[0]].tolist()
+        # Slpit data to chunks which contain an event and such that are not: start s has an event if any of the frames
+        # (s, s + crop_size] has one, i.e if s is in [start_frame - crop_size, end_frame - 1) of some event
+        indices_with_event = rasterize_events(len(possible_start_indices), start_frames - crop_size, end_frames - 1)
+        indices_with_event = indices_with_event[:, 0] > 0
+        train_index_with_event.append(possible_start_indices[indices_with_event])
+        train_index_empty.append(possible_start_indices[~indices_with_event])
 
-    train_features = np.concatenate(train_features_list, axis=1)
-    train_event_matrix = np.concatenate(train_event_matrix_list, axis=0)
+    train_event_intervals = EventIntervals(*[np.concatenate(x) for x in zip(*train_event_frames)])
+    train_index_with_event = np.concatenate(train_index_with_event).astype(np.int64)
+    train_index_empty = np.concatenate(train_index_empty).astype(np.int64)
 
     # Balance classes in train data
     np.random.shuffle(train_index_with_event)
@@ -184,81 +300,85 @@ def _read_train_data_to_memory(train_feature_paths, crop_size, balance_classes=F
     train_start_indices = np.concatenate((train_index_empty, train_index_with_event))
     np.random.shuffle(train_start_indices)
 
-    return train_features, train_event_matrix, train_start_indices
+    return train_event_intervals, train_start_indices, np.array(train_file_offsets, dtype=np.int64), frame_index
 
 
-def _read_validation_data_to_memory(feature_paths):
-    # Load validation feature and targets
-    features_list = []
-    event_matrix_list = []
-    for feature_path in feature_paths:
-        data = pickle.load(open(feature_path, 'rb'))
-        feature = data['features']
-        event_matrix = create_event_matrix(feature.shape[1], data['start_times'], data['end_times'])
-
-        features_list.append(feature)
-        event_matrix_list.append(event_matrix)
-
-    return features_list, event_matrix_list
-
-
-def create_event_matrix(frames_num, start_times, end_times):
+def get_event_frames(frames_num, start_times, end_times, class_ids=None):
     """
-    Create a per-frame classification matrix whith 1 in times specified by start/end times and 0 elsewhere
+    The frames [start_frames, end_frames) of each event clipped to [0, frames_num) and their class ids (0 if None);
+    events with no frames are dropped
     """
-    # Researve space data
-    event_matrix = np.zeros((frames_num, cfg.classes_num))
+    start_frames = np.round(np.asarray(start_times, dtype=np.float64) * cfg.frames_per_second).astype(np.int64)
+    end_frames = np.round(np.asarray(end_times, dtype=np.float64) * cfg.frames_per_second).astype(np.int64) + 1
+    start_frames, end_frames = np.clip(start_frames, 0, frames_num), np.clip(end_frames, 0, frames_num)
+    class_ids = np.zeros(len(start_frames), dtype=np.int64) if class_ids is None else \
+        np.asarray(class_ids, dtype=np.int64)
+    valid = start_frames < end_frames
+    return start_frames[valid], end_frames[valid], class_ids[valid]
 
-    for n in range(len(start_times)):
-        start_frame = int(round(start_times[n] * cfg.frames_per_second))
-        end_frame = int(round(end_times[n] * cfg.frames_per_second)) + 1
 
-        event_matrix[start_frame: end_frame] = 1
-
-    return event_matrix
+def create_event_matrix(frames_num, start_times, end_times, class_ids=None):
+    """
+    Create a per-frame classification matrix (frames_num, classes_num) whith 1 in the column of each event's class in
+    times specified by its start/end times and 0 elsewhere
+    """
+    return rasterize_events(frames_num, *get_event_frames(frames_num, start_times, end_times, class_ids),
+                            cfg.classes_num)
 
 
-def preprocess_tau_sed_data(data_dir, preprocess_mode, force_preprocess=False, fold_name='eval'):
+def preprocess_tau_sed_data(data_dir, preprocess_mode, force_preprocess=False, fold_name='eval', workers=None,
+                            extra_preprocess_modes=()):
     """
     Download, extract and preprocess the tau sed datset
-    force_preprocess: Force the preprocess phase to repeate: usefull in case you change the preprocess parameters
+    force_preprocess: Force the preprocess phase to repeate: usefull in case you change the preprocess parameters.
+        Otherwise, if cfg.incremental_preprocess, only new or changed audio files are preprocessed
+    workers: number of preprocessing processes; cfg.preprocess_workers if None
+    extra_preprocess_modes: other modes to preprocess in the same pass (each audio file is decoded and transformed
+        once) so that training on them later doesn't preprocess the data again
     """
-    cfg.cfg_descriptor += f"_C-{'-'.join(cfg.tau_sed_labels)}"
-
     ambisonic_2019_data_dir = f"{data_dir}/Tau_sound_events_2019"
     audio_dir, meta_data_dir = ensure_tau_data(ambisonic_2019_data_dir, fold_name=fold_name)
 
-    processed_data_dir = os.path.join(ambisonic_2019_data_dir, 'processed', f"{dataset.spectogram_features.spectogram_configs.cfg_descriptor}")
-    features_and_labels_dir = f"{processed_data_dir}/{preprocess_mode}-features_and_labels_{fold_name}"
-    features_mean_std_file = f"{processed_data_dir}/{preprocess_mode}-features_mean_std_{fold_name}.pkl"
-    if not os.path.exists(features_and_labels_dir) or force_preprocess:
+    feature_configs = []
+    for mode in dict.fromkeys([preprocess_mode] + list(extra_preprocess_modes)):
+        feature_params = get_feature_params(mode, tau_sed_labels=cfg.tau_sed_labels)
+        processed_data_dir = get_feature_cache_dir(os.path.join(ambisonic_2019_data_dir, 'processed'), feature_params)
+        feature_configs.append(get_feature_config(mode, f"{processed_data_dir}/features_and_labels_{fold_name}",
+                                                  f"{processed_data_dir}/features_mean_std_{fold_name}.pkl"))
+    if not all(feature_store_exists(c['output_dir']) for c in feature_configs) or force_preprocess or \
+            cfg.incremental_preprocess:
         audio_paths_and_labels = get_tau_sed_paths_and_labels(audio_dir, meta_data_dir)
-        preprocess_data(audio_paths_and_labels, output_dir=features_and_labels_dir,
-                        output_mean_std_file=features_mean_std_file, preprocess_mode=preprocess_mode)
+        preprocess_data_multi_config(audio_paths_and_labels, feature_configs, workers=workers,
+                                     incremental=cfg.incremental_preprocess and not force_preprocess)
     else:
         print("Using existing mel features")
-    return features_and_labels_dir, features_mean_std_file
+    return feature_configs[0]['output_dir'], feature_configs[0]['output_mean_std_file']
 
 
-def preprocess_film_clap_data(data_dir, preprocessed_mode, force_preprocess=False):
+def preprocess_film_clap_data(data_dir, preprocessed_mode, force_preprocess=False, workers=None,
+                              extra_preprocess_modes=()):
     """
     Preprocess and Creates a data generator for the film_clap dataset
     """
     film_clap_dir = os.path.join(data_dir, 'FilmClap')
     audio_and_labels_dir = os.path.join(film_clap_dir)
-    cfg.cfg_descriptor += f"_tm-{cfg.time_margin}"
     if not os.path.exists(film_clap_dir):
         raise Exception("You should get you own dataset...")
-    features_and_labels_dir = f"{film_clap_dir}/processed/{dataset.spectogram.spectogram_configs.cfg_descriptor}/{preprocessed_mode}-features_and_labels"
-    features_mean_std_file = f"{film_clap_dir}/processed/{dataset.spectogram.spectogram_configs.cfg_descriptor}/{preprocessed_mode}-features_mean_std.pkl"
-    if not os.path.exists(features_and_labels_dir) or force_preprocess:
+    feature_configs = []
+    for mode in dict.fromkeys([preprocessed_mode] + list(extra_preprocess_modes)):
+        feature_params = get_feature_params(mode, time_margin=cfg.time_margin)
+        processed_data_dir = get_feature_cache_dir(os.path.join(film_clap_dir, 'processed'), feature_params)
+        feature_configs.append(get_feature_config(mode, f"{processed_data_dir}/features_and_labels",
+                                                  f"{processed_data_dir}/features_mean_std.pkl"))
+    if not all(feature_store_exists(c['output_dir']) for c in feature_configs) or force_preprocess or \
+            cfg.incremental_preprocess:
         print("preprocessing raw data")
         audio_paths_and_labels = get_film_clap_paths_and_labels(audio_and_labels_dir, time_margin=cfg.time_margin)
-        preprocess_data(audio_paths_and_labels, output_dir=features_and_labels_dir,
-                        output_mean_std_file=features_mean_std_file, preprocess_mode=preprocessed_mode)
+        preprocess_data_multi_config(audio_paths_and_labels, feature_configs, workers=workers,
+                                     incremental=cfg.incremental_preprocess and not force_preprocess)
     else:
         print("Using existing mel features")
-    return features_and_labels_dir, features_mean_std_file
+    return feature_configs[0]['output_dir'], feature_configs[0]['output_mean_std_file']
 
 
 def split_train_val(feature_names, val_descriptor):
@@ -0,0 +1,139 @@
+import argparse
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import dataset.spectogram.spectogram_configs as cfg
+from dataset.spectogram.preprocess import windowed_frames_rfft, multichannel_complex_to_log_mel, multichannel_stft
+
+
+class StreamingLogMel:
+    """
+    Incremental version of multichannel_complex_to_log_mel(multichannel_stft(signal)) for live audio.
+    Chunks of any size are fed to process() which returns the log mel frames completed by them; flush() ends the stream
+    and returns the frames that need the reflect padding of its end. The concatenated outputs are equal to the offline
+    features of the whole signal.
+    Only the samples of the next frames are kept (about frame_size + NFFT // 2 samples per channel) so memory doesn't
+    grow with the length of the stream. Frame t is centered on sample t * hop_size so it is emitted once sample
+    t * hop_size + frame_size // 2 arrived; the first frame also waits for NFFT // 2 + 1 samples to reflect the start
+    of the signal like center=True does.
+    """
+    def __init__(self, channels_num=None):
+        self.channels_num = channels_num or cfg.audio_channels
+        self.pad = cfg.NFFT // 2
+        # Offset of the analysis window inside the NFFT long frame
+        self.window_offset = (cfg.NFFT - cfg.frame_size) // 2
+        self.reset()
+
+    def reset(self):
+        self.samples_num = 0
+        self.frames_num = 0
+        # Samples received before the start of the signal can be reflected
+        self.head = np.zeros((0, self.channels_num), dtype=np.float32)
+        # Reflect padded signal starting at index 'buffer_start' of the padded signal
+        self.buffer = None
+        self.buffer_start = 0
+        # Last pad + 1 samples of the signal, reflected by flush()
+        self.tail = np.zeros((0, self.channels_num), dtype=np.float32)
+
+    def process(self, chunk):
+        """
+        Args:
+            chunk: (samples, channels) or (samples,) array of any length
+        Returns:
+            (channels, new_frames, mel_bins) log mel frames completed by this chunk
+        """
+        chunk = np.asarray(chunk, dtype=np.float32)
+        if chunk.ndim == 1:
+            chunk = chunk[:, None]
+        self.samples_num += len(chunk)
+        self.tail = np.concatenate([self.tail, chunk])[-(self.pad + 1):]
+
+        if self.buffer is None:
+            self.head = np.concatenate([self.head, chunk])
+            if len(self.head) <= self.pad:
+                return self._empty_output()
+            # Reflection of the start of the signal: head[pad], ..., head[1]
+            self.buffer = np.concatenate([self.head[self.pad:0:-1], self.head])
+            self.head = None
+        else:
+            self.buffer = np.concatenate([self.buffer, chunk])
+
+        return self._emit_frames()
+
+    def flush(self):
+        """
+        Ends the stream: returns the remaining frames, computed with the end of the signal reflected, and resets the
+        object for a new stream
+        """
+        if self.buffer is None:
+            # Shorter than NFFT // 2 + 1 samples: not a single frame was emitted
+            output = self._empty_output()
+            if len(self.head) > 0:
+                output = multichannel_complex_to_log_mel(multichannel_stft(self.head))
+            self.reset()
+            return output
+
+        # Reflection of the end of the signal: tail[-2], ..., tail[0]
+        self.buffer = np.concatenate([self.buffer, self.tail[-2::-1]])
+        output = self._emit_frames(max_frames=1 + (self.samples_num + 2 * self.pad - cfg.NFFT) // cfg.hop_size)
+        self.reset()
+        return output
+
+    def _emit_frames(self, max_frames=None):
+        buffer_end = self.buffer_start + len(self.buffer)
+        # Frame t covers [t * hop_size + window_offset, t * hop_size + window_offset + frame_size) of the padded signal
+        frames_num = (buffer_end - self.window_offset - cfg.frame_size) // cfg.hop_size + 1
+        if max_frames is not None:
+            frames_num = min(frames_num, max_frames)
+        new_frames = frames_num - self.frames_num
+        if new_frames <= 0:
+            return self._empty_output()
+
+        first = self.frames_num * cfg.hop_size + self.window_offset - self.buffer_start
+        # (channels, new_frames, frame_size)
+        frames = sliding_window_view(self.buffer[first:], cfg.frame_size, axis=0)[::cfg.hop_size][:new_frames]
+        output = multichannel_complex_to_log_mel(windowed_frames_rfft(frames.transpose(1, 0, 2)))
+
+        self.frames_num = frames_num
+        # Drop the samples that no future frame covers
+        next_start = self.frames_num * cfg.hop_size + self.window_offset
+        self.buffer = self.buffer[next_start - self.buffer_start:].copy()
+        self.buffer_start = next_start
+
+        return output
+
+    def _empty_output(self):
+        return np.zeros((self.channels_num, 0, cfg.mel_bins), dtype=np.float32)
+
+
+def check_parity(duration=20, seed=0):
+    """
+    Streams random signals in chunks of random sizes and returns the max absolute difference (dB) from the offline
+    features
+    """
+    rng = np.random.RandomState(seed)
+    streamer = StreamingLogMel()
+    max_error = 0
+    for samples_num in [int(cfg.working_sample_rate * duration), cfg.NFFT + 17, cfg.NFFT // 4]:
+        signal = (rng.randn(samples_num, cfg.audio_channels) * 0.1).astype(np.float32)
+        outputs = []
+        start = 0
+        while start < samples_num:
+            chunk_size = rng.randint(1, 3 * cfg.hop_size)
+            outputs.append(streamer.process(signal[start: start + chunk_size]))
+            start += chunk_size
+        outputs.append(streamer.flush())
+        streamed = np.concatenate(outputs, axis=1)
+
+        reference = multichannel_complex_to_log_mel(multichannel_stft(signal))
+        assert reference.shape == streamed.shape, (reference.shape, streamed.shape)
+        max_error = max(max_error, np.abs(reference - streamed).max())
+    return max_error
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the streaming log mel to the offline features')
+    parser.add_argument('--duration', type=float, default=20)
+    args = parser.parse_args()
+    print(f"Max log mel difference from the offline features: {check_parity(args.duration):.6f}dB")
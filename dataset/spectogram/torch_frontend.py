@@ -0,0 +1,135 @@
+import numpy as np
+import torch
+
+import dataset.spectogram.spectogram_configs as cfg
+from dataset.spectogram.feature_constants import get_mel_filter_bank
+
+# Max absolute difference (dB) from multichannel_complex_to_log_mel(multichannel_stft(x)) on log mel values above
+# -60dB. Both compute float32 FFTs, the difference comes from the FFT implementations and summation order.
+PARITY_TOLERANCE_DB = 1e-3
+
+
+class LogMelFrontend(torch.nn.Module):
+    """
+    Batched torch implementation of multichannel_stft and multichannel_complex_to_log_mel.
+    Works on (batch, channels, samples) tensors; all files and channels are transformed in one torch.stft call that
+    uses torch's intra-op thread pool.
+    """
+    def __init__(self):
+        super(LogMelFrontend, self).__init__()
+        # np.hanning is the symmetric hann window
+        self.register_buffer('window', torch.hann_window(cfg.frame_size, periodic=False, dtype=torch.float32))
+        # Rows of the filter bank outside its support are zeros
+        mel_filter_bank = get_mel_filter_bank()
+        self.first_bin, self.last_bin = mel_filter_bank.first_bin, mel_filter_bank.last_bin
+        self.register_buffer('mel_filter_bank', torch.from_numpy(mel_filter_bank.matrix.astype(np.float32)))
+
+    def stft(self, waveforms, center=True):
+        """
+        waveforms: (batch, channels, samples) -> complex spectogram (batch, channels, frames, NFFT // 2 + 1)
+        """
+        batch_size, channels_num, samples_num = waveforms.shape
+        complex_spectogram = torch.stft(waveforms.reshape(batch_size * channels_num, samples_num),
+                                        n_fft=cfg.NFFT,
+                                        hop_length=cfg.hop_size,
+                                        win_length=cfg.frame_size,
+                                        window=self.window,
+                                        center=center,
+                                        pad_mode='reflect',
+                                        return_complex=True)
+        complex_spectogram = complex_spectogram.transpose(1, 2)
+        return complex_spectogram.reshape(batch_size, channels_num, *complex_spectogram.shape[1:])
+
+    def complex_to_log_mel(self, complex_spectogram, bin_offset=0):
+        """
+        bin_offset: frequency bin of the first bin of complex_spectogram, which should cover [first_bin, last_bin)
+        """
+        complex_spectogram = complex_spectogram[..., self.first_bin - bin_offset: self.last_bin - bin_offset]
+        power_spectogram = complex_spectogram.real ** 2 + complex_spectogram.imag ** 2
+        mel_spectogram = torch.matmul(power_spectogram.to(self.mel_filter_bank.dtype), self.mel_filter_bank)
+        return 10 * torch.log10(torch.clamp(mel_spectogram, min=1e-10))
+
+    def forward(self, waveforms):
+        return self.complex_to_log_mel(self.stft(waveforms))
+
+
+class BatchTransform(torch.nn.Module):
+    """
+    SpectogramDataset.transform of a whole (batch, channels, frames, bins) batch: normalization with the mean and std of
+    the train data and, for complex spectograms, the log mel projection. Moved to the training device by the trainer.
+    """
+    def __init__(self, mean, std, preprocessed_mode, bin_offset=0):
+        super(BatchTransform, self).__init__()
+        mean = np.asarray(mean, dtype=np.complex64 if np.iscomplexobj(mean) else np.float32)
+        self.register_buffer('mean', torch.tensor(mean))
+        self.register_buffer('std', torch.tensor(np.asarray(std, dtype=np.float32)))
+        self.bin_offset = bin_offset
+        self.log_mel_frontend = LogMelFrontend() if preprocessed_mode == 'Complex' else None
+
+    def forward(self, x):
+        x = (x - self.mean) / self.std
+        if self.log_mel_frontend is None:
+            return x
+        return self.log_mel_frontend.complex_to_log_mel(x, bin_offset=self.bin_offset)
+
+
+_frontend = None
+
+
+def get_frontend():
+    global _frontend
+    if _frontend is None:
+        _frontend = LogMelFrontend()
+    return _frontend
+
+
+def batch_stft_and_log_mel(multichannel_signals, preprocess_mode='logMel'):
+    """
+    Computes the features of several files in one pass.
+    Args:
+        multichannel_signals: list of (samples, channels) arrays, possibly of different lengths
+    Returns:
+        a list of (channels, frames, mel_bins) float32 log mel spectograms or (channels, frames, NFFT // 2 + 1)
+        complex64 spectograms, the same as multichannel_stft (+ multichannel_complex_to_log_mel) per file
+    """
+    frontend = get_frontend()
+    # Reflect pad each file like center=True does so zero padding the batch to a common length doesn't change the
+    # frames of the shorter files
+    padded_signals = [np.pad(np.asarray(x, dtype=np.float32).T, ((0, 0), (cfg.NFFT // 2, cfg.NFFT // 2)), mode='reflect')
+                      for x in multichannel_signals]
+    max_length = max(x.shape[1] for x in padded_signals)
+    batch = np.zeros((len(padded_signals), padded_signals[0].shape[0], max_length), dtype=np.float32)
+    for i, x in enumerate(padded_signals):
+        batch[i, :, :x.shape[1]] = x
+
+    with torch.no_grad():
+        features = frontend.stft(torch.from_numpy(batch), center=False)
+        if preprocess_mode == 'logMel':
+            features = frontend.complex_to_log_mel(features)
+    features = features.numpy()
+
+    return [features[i, :, :len(x) // cfg.hop_size + 1] for i, x in enumerate(multichannel_signals)]
+
+
+def check_parity(duration=30, seed=0):
+    """
+    Compares the frontend against multichannel_stft and multichannel_complex_to_log_mel on random signals of
+    different lengths and returns the max absolute log mel difference in dB (see PARITY_TOLERANCE_DB)
+    """
+    from dataset.spectogram.preprocess import multichannel_stft, multichannel_complex_to_log_mel
+    rng = np.random.RandomState(seed)
+    signals = [(rng.randn(int(cfg.working_sample_rate * duration * f), cfg.audio_channels) * 0.1).astype(np.float32)
+               for f in [1, 0.7, 0.35]]
+    max_error = 0
+    for signal, log_mel in zip(signals, batch_stft_and_log_mel(signals)):
+        reference = multichannel_complex_to_log_mel(multichannel_stft(signal))
+        assert reference.shape == log_mel.shape, (reference.shape, log_mel.shape)
+        relevant = reference > -60
+        max_error = max(max_error, np.abs(reference - log_mel)[relevant].max())
+    return max_error
+
+
+if __name__ == '__main__':
+    error = check_parity()
+    print(f"Max log mel difference from the numpy frontend: {error:.5f}dB (tolerance {PARITY_TOLERANCE_DB}dB)")
+    assert error <= PARITY_TOLERANCE_DB
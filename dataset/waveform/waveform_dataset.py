@@ -4,7 +4,7 @@ import numpy as np
 import torch
 
 from dataset.waveform import waveform_configs as cfg
-from dataset.dataset_utils import read_multichannel_audio
+from dataset.dataset_utils import read_multichannel_audio, encode_audio_samples, decode_audio_samples, EventIntervals
 
 
 def split_to_frames_with_hop_size(waveform, start_times, end_times):
@@ -30,17 +30,15 @@ def split_to_frames_with_hop_size(waveform, start_times, end_times):
     return frames, labels
 
 
-def get_start_indices_labesl(waveform_length, start_times, end_times):
+def get_start_indices_intervals(waveform_length, start_times, end_times):
     """
-    Returns: a waveform_length size boolean array where the ith entry says wheter or not a frame starting from the ith
-    sample is covered by an event
+    Returns: the intervals [first, last) of start indices (clipped to [0, waveform_length)) of frames that are covered
+    by each event
     """
-    label = np.zeros(waveform_length)
-    for start, end in zip(start_times, end_times):
-        event_first_start_index = int(start * cfg.working_sample_rate - cfg.frame_size * (1 - cfg.min_event_percentage_in_positive_frame))
-        event_last_start_index = int(end * cfg.working_sample_rate - cfg.frame_size * cfg.min_event_percentage_in_positive_frame)
-        label[event_first_start_index: event_last_start_index] = 1
-    return label
+    start_times, end_times = np.asarray(start_times, dtype=np.float64), np.asarray(end_times, dtype=np.float64)
+    event_first_start_indices = (start_times * cfg.working_sample_rate - cfg.frame_size * (1 - cfg.min_event_percentage_in_positive_frame)).astype(np.int64)
+    event_last_start_indices = (end_times * cfg.working_sample_rate - cfg.frame_size * cfg.min_event_percentage_in_positive_frame).astype(np.int64)
+    return np.clip(event_first_start_indices, 0, waveform_length), np.clip(event_last_start_indices, 0, waveform_length)
 
 
 class WaveformDataset:
@@ -48,37 +46,39 @@ class WaveformDataset:
     This dataset allows training a detector on raw waveforms.
     It splits all waveforms to frames of a defined size with some overlap and tags gives them a tag of one of the classes
     or zero for no-event.
+    Waveforms are kept in memory as cfg.audio_storage_dtype samples and decoded to float32 per crop.
     """
     def __init__(self, audio_paths_labels_and_names, val_descriptor=0.15, balance_classes=False, augment_data=False):
         self.balance_classes = balance_classes
         self.augment_data = augment_data
+        self.sample_scale = 1.0
 
         print("WaveformDataset:")
         print("\t- Loading samples into memory... ")
         train_audio_paths_labels_and_names, val_audio_paths_labels_and_names = split_train_val(audio_paths_labels_and_names, val_descriptor)
 
         self.long_waveform = []
-        self.all_start_indices_labels = []
+        start_indices_intervals = []
         self.possible_start_indices = []
         frame_index = 0
 
-        for i, (audio_path, start_times, end_times, audio_name) in enumerate(train_audio_paths_labels_and_names):
+        for i, (audio_path, start_times, end_times, audio_name, _) in enumerate(train_audio_paths_labels_and_names):
             waveform = read_multichannel_audio(audio_path, target_fs=cfg.working_sample_rate)
-            waveform = waveform.T # -> (channels, samples)
+            waveform, self.sample_scale = encode_audio_samples(waveform.T, cfg.audio_storage_dtype) # -> (channels, samples)
 
             self.long_waveform.append(waveform)
 
             # restrict the starting indices so that random crop are not taken over two different waveforms
             possible_start_indices = np.arange(frame_index, frame_index + waveform.shape[1] - cfg.frame_size, dtype=np.uint32)
             self.possible_start_indices.append(possible_start_indices)
-            frame_index += waveform.shape[1]
 
-            # Store the correct label for each starting sample index of a frame
-            label_per_start_index = get_start_indices_labesl(waveform.shape[1], start_times, end_times).astype(bool)
-            self.all_start_indices_labels.append(label_per_start_index)
+            # Store the intervals of the starting sample indices of frames that are labeled as event
+            first_start_indices, last_start_indices = get_start_indices_intervals(waveform.shape[1], start_times, end_times)
+            start_indices_intervals.append((first_start_indices + frame_index, last_start_indices + frame_index))
+            frame_index += waveform.shape[1]
 
         self.long_waveform = np.concatenate(self.long_waveform, axis=1)
-        self.all_start_indices_labels = np.concatenate(self.all_start_indices_labels)
+        self.start_indices_labels = EventIntervals(*[np.concatenate(x) for x in zip(*start_indices_intervals)])
         self.possible_start_indices = np.concatenate(self.possible_start_indices)
 
         np.random.shuffle(self.possible_start_indices)
@@ -87,9 +87,9 @@ class WaveformDataset:
         self.val_samples_sets = []
         self.val_label_sets = []
         self.val_file_names = []
-        for i, (audio_path, start_times, end_times, audio_name) in enumerate(val_audio_paths_labels_and_names):
+        for i, (audio_path, start_times, end_times, audio_name, _) in enumerate(val_audio_paths_labels_and_names):
             waveform = read_multichannel_audio(audio_path, target_fs=cfg.working_sample_rate)
-            waveform = waveform.T # -> (channels, samples)
+            waveform, self.sample_scale = encode_audio_samples(waveform.T, cfg.audio_storage_dtype) # -> (channels, samples)
             # Split wave form to overlapping frames and create labels for each
             frames, labels = split_to_frames_with_hop_size(waveform, start_times, end_times)
             self.val_samples_sets.append(frames)
@@ -97,14 +97,15 @@ class WaveformDataset:
             self.val_file_names.append(audio_name)
 
 
-        print(f"\t- Train split: {len(self.possible_start_indices)} overlapping fames. ~{100*np.sum(self.all_start_indices_labels==1)/len(self.possible_start_indices):.1f}% tagged as event")
+        print(f"\t- Train split: {len(self.possible_start_indices)} overlapping fames. ~{100*self.start_indices_labels.covered_length()/len(self.possible_start_indices):.1f}% tagged as event")
         print(f"\t- Val split: {np.sum([ len(x) for x in self.val_label_sets])} frames. {np.sum([ np.sum(x) for x in self.val_label_sets])} tagged as event")
 
     def get_validation_sampler(self, max_validate_num):
         for i, (frames, labels, file_names) in enumerate(zip(self.val_samples_sets, self.val_label_sets, self.val_file_names)):
             if i > max_validate_num:
                 break
-            yield torch.tensor(frames), torch.tensor(labels), file_names
+            frames = decode_audio_samples(np.stack(frames), self.sample_scale)
+            yield torch.from_numpy(frames), torch.tensor(labels), file_names
 
     def __len__(self):
         return len(self.possible_start_indices)
@@ -112,8 +113,8 @@ class WaveformDataset:
     def __getitem__(self, idx):
         start_index = self.possible_start_indices[idx]
 
-        waveform = self.long_waveform[:, start_index + np.arange(cfg.frame_size)]
-        label = self.all_start_indices_labels[start_index]
+        waveform = self.get_waveform_crop(start_index)
+        label = self.start_indices_labels.is_covered(start_index)
 
         if self.augment_data:
             waveform, label = self.augment_mix_samples(waveform, label)
@@ -121,12 +122,15 @@ class WaveformDataset:
 
         return waveform, label
 
+    def get_waveform_crop(self, start_index):
+        return decode_audio_samples(self.long_waveform[:, start_index: start_index + cfg.frame_size], self.sample_scale)
+
     def augment_mix_samples(self, waveform, label):
         number_of_augmentations = np.random.choice([0, 1, 2, 3], 1, p=[0.5, 0.3, 0.15, 0.05])[0]
         for i in range(number_of_augmentations):
             random_start_idx = np.random.choice(self.possible_start_indices)
-            waveform += self.long_waveform[:, random_start_idx + np.arange(cfg.frame_size)]
-            label = max(label, self.all_start_indices_labels[random_start_idx])
+            waveform += self.get_waveform_crop(random_start_idx)
+            label = max(label, self.start_indices_labels.is_covered(random_start_idx))
         waveform /= (number_of_augmentations + 1)
         return waveform, label
 
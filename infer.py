@@ -2,7 +2,7 @@ import argparse
 import os
 from models import *
 from dataset.spectogram import spectogram_configs as cfg
-from dataset.spectogram.preprocess import multichannel_stft, multichannel_complex_to_log_mel
+from dataset.spectogram.preprocess import extract_features
 from dataset.dataset_utils import read_multichannel_audio
 from utils import plot_debug_image
 
@@ -26,7 +26,7 @@ if __name__ == '__main__':
 
     multichannel_audio = read_multichannel_audio(audio_path=args.audio_file, target_fs=cfg.working_sample_rate)
 
-    log_mel_features = multichannel_complex_to_log_mel(multichannel_stft(multichannel_audio))[0]
+    log_mel_features = extract_features(multichannel_audio, 'logMel')[0]
 
     print("Inference..")
     with torch.no_grad():
@@ -17,11 +17,15 @@ def get_spectogram_dataset_model_and_criterion(args):
         features_and_labels_dir, features_mean_std_file = preprocess_tau_sed_data(args.dataset_dir,
                                                                                   fold_name='eval',
                                                                                   preprocess_mode=args.preprocess_mode,
-                                                                                  force_preprocess=args.force_preprocess)
+                                                                                  force_preprocess=args.force_preprocess,
+                                                                                  workers=args.preprocess_workers,
+                                                                                  extra_preprocess_modes=args.extra_preprocess_modes)
     elif args.dataset_name.lower() == "filmclap":
         features_and_labels_dir, features_mean_std_file = preprocess_film_clap_data(args.dataset_dir,
                                                                                     preprocessed_mode=args.preprocess_mode,
-                                                                                    force_preprocess=args.force_preprocess)
+                                                                                    force_preprocess=args.force_preprocess,
+                                                                                    workers=args.preprocess_workers,
+                                                                                    extra_preprocess_modes=args.extra_preprocess_modes)
     else:
         raise ValueError(f"Only tau and filmclap datasets are supported, '{args.dataset_name}' given")
 
@@ -41,26 +45,48 @@ def get_spectogram_dataset_model_and_criterion(args):
     # define the crieterion
     criterion = WeightedBCE(recall_factor=args.recall_priority, multi_frame=True)
 
-    full_descriptor = f"{args.preprocess_mode}-{cfg.cfg_descriptor}"
+    # The features directory is named '<preprocess_mode>-<cache key>' by the hash of all the feature and label parameters
+    # (e.g the classes or the time margin)
+    feature_cache_key = os.path.basename(os.path.dirname(features_and_labels_dir)).split('-')[-1]
+    full_descriptor = f"{args.preprocess_mode}-{cfg.cfg_descriptor}_key-{feature_cache_key}"
 
     return dataset, model, criterion, full_descriptor
 
 
 def get_waveform_dataset_and_model(args):
     from dataset.waveform.waveform_dataset import WaveformDataset
-    from dataset.waveform.waveform_configs import cfg_descriptor, time_margin
+    from dataset.waveform import waveform_configs as cfg
     from models.waveform_models import M5
-    from dataset.dataset_utils import get_film_clap_paths_and_labels, get_tau_sed_paths_and_labels
+    from dataset.dataset_utils import get_film_clap_paths_and_labels, get_tau_sed_paths_and_labels, \
+        FILM_CLAP_LABELS_FILE
     from dataset.download_tau_sed_2019 import ensure_tau_data
+    from dataset.manifest import build_manifest, load_manifest_if_current, manifest_to_paths_and_labels, \
+        print_manifest_summary
+    from dataset.spectogram.feature_params import get_feature_cache_key
 
+    # The labels and audio headers are parsed only if they changed since the manifest was saved
     if args.dataset_name.lower() == "tau":
         audio_dir, meta_data_dir = ensure_tau_data(f"{args.dataset_dir}/Tau_sound_events_2019", fold_name='eval')
-        audio_paths_labels_and_names = get_tau_sed_paths_and_labels(audio_dir, meta_data_dir)
+        manifest_path = f"{args.dataset_dir}/Tau_sound_events_2019/manifest_eval.npz"
+        label_params = {'tau_sed_labels': cfg.tau_sed_labels}
+        source_paths = [audio_dir, meta_data_dir] + [os.path.join(meta_data_dir, name) for name in os.listdir(meta_data_dir)]
+        manifest = load_manifest_if_current(manifest_path, source_paths, label_params)
+        if manifest is None:
+            manifest = build_manifest(get_tau_sed_paths_and_labels(audio_dir, meta_data_dir), manifest_path, label_params)
     elif args.dataset_name.lower() == "filmclap":
-        audio_paths_labels_and_names = get_film_clap_paths_and_labels(os.path.join(args.dataset_dir, 'FilmClap'), time_margin)
+        film_clap_dir = os.path.join(args.dataset_dir, 'FilmClap')
+        manifest_path = os.path.join(film_clap_dir, 'manifest.npz')
+        label_params = {'time_margin': cfg.time_margin}
+        manifest = load_manifest_if_current(manifest_path, [os.path.join(film_clap_dir, FILM_CLAP_LABELS_FILE)], label_params)
+        if manifest is None:
+            manifest = build_manifest(get_film_clap_paths_and_labels(film_clap_dir, cfg.time_margin), manifest_path,
+                                      label_params)
     else:
         raise ValueError(f"Only tau and filmclap datasets are supported, '{args.dataset_name}' given")
 
+    print_manifest_summary(manifest, cfg.working_sample_rate, cfg.audio_channels, cfg.audio_storage_dtype)
+    audio_paths_labels_and_names = manifest_to_paths_and_labels(manifest)
+
     dataset = WaveformDataset(audio_paths_labels_and_names,
                               augment_data=args.augment_data,
                               balance_classes=args.balance_classes,
@@ -70,7 +96,7 @@ def get_waveform_dataset_and_model(args):
 
     criterion = WeightedBCE(recall_factor=args.recall_priority, multi_frame=False)
 
-    return dataset, model, criterion, cfg_descriptor
+    return dataset, model, criterion, f"{cfg.cfg_descriptor}_key-{get_feature_cache_key(label_params)}"
 
 
 def get_dataset_and_model(args):
@@ -93,6 +119,9 @@ if __name__ == '__main__':
     # Spectogram only arguments
     parser.add_argument('--preprocess_mode', type=str, default='logMel', help='logMel or Complex; relevant only for Spectogram features')
     parser.add_argument('--force_preprocess', action='store_true', default=False, help='relevant only for Spectogram features')
+    parser.add_argument('--preprocess_workers', type=int, default=None, help='Preprocessing processes; cfg.preprocess_workers if not set')
+    parser.add_argument('--extra_preprocess_modes', nargs='*', default=[],
+                        help='Other preprocess modes to preprocess in the same pass (e.g Complex while training on logMel)')
 
     # Train
     parser.add_argument('--outputs_root', type=str, default='training_dir')
@@ -122,7 +151,8 @@ if __name__ == '__main__':
 
     dataset, model, criterion, cfg_descriptor = get_dataset_and_model(args)
 
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                            collate_fn=getattr(dataset, 'collate_fn', None))
 
     model = model.to(device)
     model.model_description()
@@ -16,12 +16,19 @@ def eval(model, dataloader, criterion, outputs_dir, iteration, device, limit_val
     debug_targets = []
     debug_inputs = []
     debug_file_names = []
+    batch_transform = getattr(dataloader.dataset, 'batch_transform', None)
+    if batch_transform is not None:
+        batch_transform.to(device)
     val_sampler = dataloader.dataset.get_validation_sampler(max_validate_num=limit_val_samples)
     for idx, (input, target, file_name) in enumerate(val_sampler):
         model.eval()
         with torch.no_grad():
             model.eval()
-            output = model(input.to(device).float()).cpu()
+            input = input.to(device)
+            if batch_transform is not None:
+                input = batch_transform(input)
+            output = model(input.float()).cpu()
+        input = input.cpu()
 
         loss = criterion(output, target.float())
 
@@ -84,6 +91,11 @@ def train(model, data_loader, criterion, num_steps, lr, log_freq, outputs_dir, d
     # Optimizer
     optimizer = optim.Adam(model.parameters(), lr=lr, betas=(0.9, 0.999), eps=1e-08, weight_decay=0., amsgrad=True)
 
+    # Datasets may leave the normalization of the features to the trainer so it is done on whole batches
+    batch_transform = getattr(data_loader.dataset, 'batch_transform', None)
+    if batch_transform is not None:
+        batch_transform.to(device)
+
     iterations = 0
     epoch = 0
     training_start_time = time()
@@ -94,7 +106,11 @@ def train(model, data_loader, criterion, num_steps, lr, log_freq, outputs_dir, d
             tqdm_bar.update()
             # forward
             model.train()
-            batch_outputs = model(batch_features.to(device).float())
+            batch_features = batch_features.to(device)
+            if batch_transform is not None:
+                with torch.no_grad():
+                    batch_features = batch_transform(batch_features)
+            batch_outputs = model(batch_features.float())
             loss = criterion(batch_outputs, event_labels.to(device).float())
 
             # Backward
@@ -113,5 +113,36 @@ def human_format(num):
     return '%.1f%s' % (num, ['', 'K', 'M', 'G', 'T', 'P'][magnitude])  # add more suffices if you need them
 
 
+def atomic_write(path, write_function, mode='wb'):
+    """
+    Writes path through write_function(f) into a temporary file that then replaces it, so concurrent readers never see
+    a partial file
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode) as f:
+        write_function(f)
+    os.replace(tmp_path, path)
+
+
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
+
+
+def next_fast_length(n):
+    """
+    Smallest 5-smooth number (2^a * 3^b * 5^c) >= n; FFTs of these sizes are about as fast as powers of two while
+    padding frames much less
+    """
+    best = 2 ** int(np.ceil(np.log2(n)))
+    power_of_5 = 1
+    while power_of_5 < best:
+        power_of_3 = power_of_5
+        while power_of_3 < best:
+            # Smallest power of two multiple of power_of_3 that is >= n
+            candidate = power_of_3
+            while candidate < n:
+                candidate *= 2
+            best = min(best, candidate)
+            power_of_3 *= 3
+        power_of_5 *= 5
+    return best